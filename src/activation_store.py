@@ -0,0 +1,176 @@
+"""
+Created 10-17-26
+
+A persistent store of the activation functions of neural network processors, e.g., madmom's
+`RNNBeatProcessor`, such that their post-processors can be rerun, e.g., over a grid of parameters, see
+`sweep_post_processors.py`, without rerunning the networks.
+
+Activations are stored as `.npy` files, one per track, in a directory per processor and version, and
+memory-mapped on read. The version identifies the models, and any other inputs, that the activations were
+computed with, such that activations from different models are never mixed.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+
+# Python standard library imports
+import os
+import hashlib
+import tempfile
+
+
+_ENTRY_EXT = '.npy'
+
+
+class ActivationStore(object):
+    """
+    A directory of activations, keyed by track, processor and version. Safe for concurrent use by multiple
+    processes, as entries are written atomically. Processes computing the same entry at once each compute it,
+    and the last one written is kept.
+    """
+
+    def __init__(self, store_dir):
+        """
+        Constructor.
+
+        Args:
+            store_dir: str - The directory in which to store activations.
+        """
+        self.store_dir = os.path.abspath(store_dir)
+
+    def get(self, track_id, processor, version):
+        """
+        Get the stored activations of a track.
+
+        Args:
+            track_id: str - The ID of the track, e.g., "0001_12step".
+
+            processor: str - The name of the processor that computed the activations, e.g., "RNNBeatProcessor".
+
+            version: str - The version of the processor's models, see `madmom_version`.
+
+        Return:
+            np.ndarray or None - A read-only, memory-mapped array of the activations, or None if they have not
+            been stored.
+        """
+        try:
+            return np.load(self._entry(track_id, processor, version), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def put(self, track_id, processor, version, activations):
+        """
+        Stores the activations of a track, replacing any stored already.
+
+        Args:
+            track_id: str - The ID of the track.
+
+            processor: str - The name of the processor that computed the activations.
+
+            version: str - The version of the processor's models.
+
+            activations: np.ndarray - The activations.
+
+        Return:
+            np.ndarray - A read-only, memory-mapped array of the stored activations.
+        """
+        entry = self._entry(track_id, processor, version)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(prefix='tmp', suffix=_ENTRY_EXT, dir=os.path.dirname(entry))
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.save(tmp_file, np.asarray(activations))
+            os.replace(tmp_fname, entry)
+        except BaseException:
+            os.remove(tmp_fname)
+            raise
+        return self.get(track_id, processor, version)
+
+    def compute(self, track_id, processor, version, func, *args):
+        """
+        Get the stored activations of a track, computing and storing them if not yet stored.
+
+        Args:
+            track_id: str - The ID of the track.
+
+            processor: str - The name of the processor that computes the activations.
+
+            version: str - The version of the processor's models.
+
+            func: function - A function that computes the activations.
+
+            args: list(*) - The arguments of `func`.
+
+        Return:
+            np.ndarray - A read-only, memory-mapped array of the activations.
+        """
+        activations = self.get(track_id, processor, version)
+        if activations is None:
+            activations = self.put(track_id, processor, version, func(*args))
+        return activations
+
+    def versions(self, processor):
+        """
+        Get the versions of a processor that activations are stored for.
+
+        Args:
+            processor: str - The name of the processor.
+
+        Return:
+            list(str) - The versions, sorted.
+        """
+        try:
+            return sorted(os.listdir(os.path.join(self.store_dir, processor)))
+        except FileNotFoundError:
+            return []
+
+    def track_ids(self, processor, version):
+        """
+        Get the tracks that activations are stored for.
+
+        Args:
+            processor: str - The name of the processor.
+
+            version: str - The version of the processor's models.
+
+        Return:
+            list(str) - The IDs of the tracks, sorted.
+        """
+        try:
+            fnames = os.listdir(os.path.join(self.store_dir, processor, version))
+        except FileNotFoundError:
+            return []
+        return sorted(fname[:-len(_ENTRY_EXT)] for fname in fnames
+                      if fname.endswith(_ENTRY_EXT) and not fname.startswith('tmp'))
+
+    def _entry(self, track_id, processor, version):
+        """
+        Get the filename of the entry for a track's activations.
+        """
+        return os.path.join(self.store_dir, processor, version, track_id + _ENTRY_EXT)
+
+
+def madmom_version(*inputs):
+    """
+    Get the version of activations computed by madmom's models, i.e., the madmom release that the models
+    were distributed with, optionally combined with a hash of other inputs the activations depend on, e.g.,
+    the beat positions given to `RNNBarProcessor`.
+
+    Args:
+        inputs: list(array-like) - Other inputs that the activations depend on.
+
+    Return:
+        str - The version, e.g., "madmom-0.16.1".
+    """
+    import madmom
+    version = 'madmom-{}'.format(madmom.__version__)
+    if inputs:
+        digest = hashlib.sha1()
+        for value in inputs:
+            digest.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+        version += '-' + digest.hexdigest()[:12]
+    return version
@@ -0,0 +1,372 @@
+"""
+Created 10-17-26
+
+A compiled, columnar binary representation of the Harmonix Set annotations.
+
+All beat and segment rows for every track are packed into a handful of flat `.npy` arrays,
+alongside offset arrays indexing where each track starts and ends. These are memory-mapped
+on load, so the entire annotation set is available in milliseconds without parsing any text.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Python standard library imports
+import os
+import hashlib
+import shutil
+import tempfile
+
+
+CACHE_FORMAT_VERSION = 1
+_ARRAY_NAMES = [
+    'track_ids',
+    'beat_times',
+    'beat_numbers',
+    'bar_numbers',
+    'beat_offsets',
+    'segment_times',
+    'segment_labels',
+    'segment_offsets',
+    'label_vocabulary'
+]
+_COMPLETE_MARKER = 'COMPLETE'
+
+
+def source_fingerprint(fnames):
+    """
+    Computes a fingerprint of a set of source files from their names, sizes and modification
+    times, such that any addition, removal or change of a file results in a new fingerprint.
+
+    Args:
+        fnames: list(str) - The filenames (with path) of the source files.
+
+    Return:
+        str - A hex digest identifying the current state of the source files.
+    """
+    digest = hashlib.sha1(str(CACHE_FORMAT_VERSION).encode())
+    for fname in sorted(fnames):
+        stat = os.stat(fname)
+        digest.update('{}:{}:{}\n'.format(os.path.basename(fname), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+class RaggedArray(object):
+    """
+    A sequence of variable length arrays, e.g., one per track, stored as a single flat array
+    of values and an array of offsets. Item `i` is `values[offsets[i]:offsets[i+1]]`.
+    """
+
+    def __init__(self, values, offsets):
+        """
+        Constructor.
+
+        Args:
+            values: np.ndarray - The concatenated values of every item.
+
+            offsets: np.ndarray - An array of length `len(self) + 1` with the start position of
+            each item in `values`, followed by the total number of values.
+        """
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    @property
+    def lengths(self):
+        """
+        Get the number of values in each item.
+
+        Return:
+            np.ndarray - The length of each item.
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def item_indices(self):
+        """
+        Get the index of the item that each value belongs to.
+
+        Return:
+            np.ndarray - An array of the same length as `values`, containing item indices.
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def to_dict(self, keys):
+        """
+        Splits the ragged array into a dictionary of arrays.
+
+        Args:
+            keys: list(str) - A key for each item, e.g., the track IDs.
+
+        Return:
+            dict(str, np.ndarray) - The array for each item, as views into `values`.
+        """
+        return {str(key): self[idx] for idx, key in enumerate(keys)}
+
+
+class CompiledAnnotations(object):
+    """
+    The beats, downbeats and segments for an entire dataset, stored as flat arrays with per-track
+    offsets. The rows for the track at index `i` lie in `[offsets[i], offsets[i+1])`.
+    """
+
+    def __init__(self, arrays):
+        """
+        Constructor.
+
+        Args:
+            arrays: dict(str, np.ndarray) - The compiled arrays, keyed by their names in `_ARRAY_NAMES`.
+        """
+        self.track_ids = arrays['track_ids']
+        self.beat_times = arrays['beat_times']
+        self.beat_numbers = arrays['beat_numbers']
+        self.bar_numbers = arrays['bar_numbers']
+        self.beat_offsets = arrays['beat_offsets']
+        self.segment_times = arrays['segment_times']
+        self.segment_labels = arrays['segment_labels']
+        self.segment_offsets = arrays['segment_offsets']
+        self.label_vocabulary = arrays['label_vocabulary']
+        self._track_index = {str(track_id): idx for idx, track_id in enumerate(self.track_ids)}
+
+    @property
+    def beats(self):
+        """
+        Get the beat times of every track.
+
+        Return:
+            RaggedArray - The beat times in seconds, with one item per track in `track_ids`.
+        """
+        return RaggedArray(self.beat_times, self.beat_offsets)
+
+    @property
+    def segments(self):
+        """
+        Get the segment start times of every track.
+
+        Return:
+            RaggedArray - The segment start times in seconds, with one item per track in `track_ids`.
+        """
+        return RaggedArray(self.segment_times, self.segment_offsets)
+
+    def bar_start_rows(self):
+        """
+        Get the rows of the beat arrays at which a bar starts, i.e., the first beat of each track and
+        every beat at which the bar number increases, whatever number the first bar of a track has.
+
+        Return:
+            np.ndarray - The sorted row indices into the beat arrays.
+        """
+        track_starts = self.beat_offsets[:-1][self.beat_offsets[1:] > self.beat_offsets[:-1]]
+        bar_change = np.zeros(len(self.bar_numbers), dtype=bool)
+        bar_change[1:] = self.bar_numbers[1:] > self.bar_numbers[:-1]
+        bar_change[track_starts] = True
+        return np.flatnonzero(bar_change)
+
+    def shift_rows(self, rows, offset):
+        """
+        Shifts rows of the beat arrays by a number of beats, dropping those shifted outside of their track.
+
+        Args:
+            rows: np.ndarray - Sorted row indices into the beat arrays.
+
+            offset: int - The number of beats to shift each row by.
+
+        Return:
+            np.ndarray - The sorted, shifted row indices.
+        """
+        rows = np.asarray(rows)
+        tracks = np.searchsorted(self.beat_offsets, rows, side='right') - 1
+        shifted = rows + offset
+        return shifted[(shifted >= self.beat_offsets[tracks]) & (shifted < self.beat_offsets[tracks + 1])]
+
+    def beat_times_at(self, rows):
+        """
+        Get the times of a set of beats, grouped by track.
+
+        Args:
+            rows: np.ndarray - Sorted row indices into the beat arrays.
+
+        Return:
+            RaggedArray - The read-only beat times in seconds, with one item per track in `track_ids`.
+        """
+        times = self.beat_times[rows]
+        times.flags.writeable = False
+        return RaggedArray(times, np.searchsorted(rows, self.beat_offsets, side='left'))
+
+    def downbeat_times(self, offsets):
+        """
+        Computes the downbeat positions of every track, for several beat offsets at once, without
+        looping over tracks. The downbeats are the first beat of every bar, see `bar_start_rows`,
+        shifted by the beat offset. Shifted positions that fall outside of a track are dropped.
+
+        Args:
+            offsets: list(int) - The beat offsets to compute downbeat positions for, for example
+            0 = the downbeat, 1 = the second beat, etc..
+
+        Return:
+            dict(int, RaggedArray) - The downbeat + beat offset times in seconds for each offset,
+            with one item per track in `track_ids`.
+        """
+        bar_starts = self.bar_start_rows()
+        return {offset: self.beat_times_at(self.shift_rows(bar_starts, offset)) for offset in offsets}
+
+    def track_index(self, track_id):
+        """
+        Get the position of a track within the compiled arrays.
+
+        Args:
+            track_id: str - The ID of the track, e.g., "0001_12step".
+
+        Return:
+            int - The index of the track into the offset arrays.
+        """
+        return self._track_index[track_id]
+
+    def beat_frame(self, track_id, columns):
+        """
+        Get the beat data for a single track as a dataframe, in the same layout as parsed
+        from the beats and downbeats text files.
+
+        Args:
+            track_id: str - The ID of the track.
+
+            columns: list(str) - The names of the beat time, beat number and bar number columns.
+
+        Return:
+            pd.DataFrame - The beat data for the track.
+        """
+        idx = self._track_index[track_id]
+        start, end = self.beat_offsets[idx], self.beat_offsets[idx + 1]
+        return pd.DataFrame({
+            columns[0]: self.beat_times[start:end],
+            columns[1]: self.beat_numbers[start:end],
+            columns[2]: self.bar_numbers[start:end]
+        }, columns=columns)
+
+    def segment_frame(self, track_id, columns):
+        """
+        Get the segment data for a single track as a dataframe, in the same layout as parsed
+        from the segments text files.
+
+        Args:
+            track_id: str - The ID of the track.
+
+            columns: list(str) - The names of the segment start and segment label columns.
+
+        Return:
+            pd.DataFrame - The segment data for the track.
+        """
+        idx = self._track_index[track_id]
+        start, end = self.segment_offsets[idx], self.segment_offsets[idx + 1]
+        labels = self.label_vocabulary[self.segment_labels[start:end]].astype(object)
+        return pd.DataFrame({
+            columns[0]: self.segment_times[start:end],
+            columns[1]: labels
+        }, columns=columns)
+
+
+def pack_annotations(beat_data, seg_data):
+    """
+    Packs the beat and segment data for every track into flat arrays with per-track offsets.
+
+    Args:
+        beat_data: dict(str, np.ndarray) - The beat rows (beat time, beat number, bar number) for each track.
+
+        seg_data: dict(str, tuple(np.ndarray, np.ndarray)) - The segment start times and labels for each track.
+
+    Return:
+        CompiledAnnotations - The packed annotations, held in memory.
+    """
+    track_ids = sorted(beat_data.keys())
+    beat_rows = [np.asarray(beat_data[track_id]).reshape(-1, 3) for track_id in track_ids]
+    seg_times = [np.asarray(seg_data[track_id][0], dtype=np.float64) for track_id in track_ids]
+    seg_labels = [np.asarray(seg_data[track_id][1]).astype(str) for track_id in track_ids]
+    all_labels = np.concatenate(seg_labels) if seg_labels else np.array([], dtype=str)
+    label_vocabulary, label_codes = np.unique(all_labels, return_inverse=True)
+
+    arrays = {
+        'track_ids': np.array(track_ids, dtype=str),
+        'beat_times': np.concatenate([rows[:, 0] for rows in beat_rows]).astype(np.float64),
+        'beat_numbers': np.concatenate([rows[:, 1] for rows in beat_rows]).astype(np.int64),
+        'bar_numbers': np.concatenate([rows[:, 2] for rows in beat_rows]).astype(np.int64),
+        'beat_offsets': np.concatenate(([0], np.cumsum([len(rows) for rows in beat_rows]))).astype(np.int64),
+        'segment_times': np.concatenate(seg_times),
+        'segment_labels': label_codes.astype(np.int32).reshape(-1),
+        'segment_offsets': np.concatenate(([0], np.cumsum([len(times) for times in seg_times]))).astype(np.int64),
+        'label_vocabulary': label_vocabulary
+    }
+    for array in arrays.values():
+        array.flags.writeable = False
+    return CompiledAnnotations(arrays)
+
+
+def compile_annotations(cache_dir, fingerprint, beat_data, seg_data):
+    """
+    Packs the beat and segment data for every track into flat arrays and saves them to disk.
+    The arrays are written to a temporary directory which is atomically renamed into place, so
+    concurrent processes compiling the same fingerprint never observe a partially written cache.
+
+    Args:
+        cache_dir: str - The directory within which to store compiled caches.
+
+        fingerprint: str - The fingerprint of the source files the data was parsed from.
+
+        beat_data: dict(str, np.ndarray) - The beat rows (beat time, beat number, bar number) for each track.
+
+        seg_data: dict(str, tuple(np.ndarray, np.ndarray)) - The segment start times and labels for each track.
+
+    Return:
+        str - The directory containing the compiled arrays.
+    """
+    annotations = pack_annotations(beat_data, seg_data)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    final_dir = os.path.join(cache_dir, fingerprint)
+    tmp_dir = tempfile.mkdtemp(prefix='tmp', dir=cache_dir)
+    try:
+        for name in _ARRAY_NAMES:
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(annotations, name))
+        open(os.path.join(tmp_dir, _COMPLETE_MARKER), 'w').close()
+        os.rename(tmp_dir, final_dir)
+    except OSError:
+        # Another process may have compiled the same fingerprint first, in which case we keep theirs.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(final_dir, _COMPLETE_MARKER)):
+            raise
+
+    # Remove caches compiled from previous states of the source files
+    for entry in os.listdir(cache_dir):
+        if entry != fingerprint and not entry.startswith('tmp'):
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+    return final_dir
+
+
+def load_annotations(cache_dir, fingerprint):
+    """
+    Memory-maps previously compiled annotation arrays.
+
+    Args:
+        cache_dir: str - The directory within which compiled caches are stored.
+
+        fingerprint: str - The fingerprint of the current source files.
+
+    Return:
+        CompiledAnnotations or None - The compiled annotations, or None if no cache exists
+        for the given fingerprint, i.e., the cache is missing or stale.
+    """
+    compiled_dir = os.path.join(cache_dir, fingerprint)
+    if not os.path.exists(os.path.join(compiled_dir, _COMPLETE_MARKER)):
+        return None
+    arrays = {name: np.load(os.path.join(compiled_dir, name + '.npy'), mmap_mode='r') for name in _ARRAY_NAMES}
+    return CompiledAnnotations(arrays)
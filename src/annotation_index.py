@@ -0,0 +1,112 @@
+"""
+Created 10-17-26
+
+Time-indexed lookups into the Harmonix Set annotations, e.g., for labeling feature frames
+with the segment, beat or bar they fall within.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+
+# Python standard library imports
+# None.
+
+
+NO_LABEL = ''
+
+
+class AnnotationIndex(object):
+    """
+    Answers batch queries of which segment, beat or bar contains each of an array of timestamps,
+    using a binary search over the sorted beat and segment times of a track.
+    """
+
+    def __init__(self, annotations):
+        """
+        Constructor.
+
+        Args:
+            annotations: annotation_cache.CompiledAnnotations - The annotations of every track.
+        """
+        self._annotations = annotations
+
+    def segment_labels_at(self, track_id, times):
+        """
+        Get the label of the segment containing each timestamp.
+
+        Args:
+            track_id: str - The ID of the track, e.g., "0001_12step".
+
+            times: np.ndarray - The timestamps in seconds.
+
+        Return:
+            np.ndarray - The segment label at each timestamp. Timestamps before the first segment are
+            labeled `NO_LABEL`, and timestamps after the end of the track are labeled "end".
+        """
+        ann = self._annotations
+        start, end = self._range(ann.segment_offsets, track_id)
+        idxs = np.searchsorted(ann.segment_times[start:end], times, side='right') - 1
+        labels = ann.label_vocabulary[ann.segment_labels[start:end][np.maximum(idxs, 0)]] if end > start \
+            else np.full(np.shape(times), NO_LABEL)
+        return np.where(idxs >= 0, labels, NO_LABEL)
+
+    def beat_indices_at(self, track_id, times):
+        """
+        Get the index of the beat containing each timestamp, i.e., the last beat at or before it.
+
+        Args:
+            track_id: str - The ID of the track.
+
+            times: np.ndarray - The timestamps in seconds.
+
+        Return:
+            np.ndarray - The index into the track's beats for each timestamp, or -1 for timestamps
+            before the first beat. Timestamps after the final beat map to the final beat.
+        """
+        ann = self._annotations
+        start, end = self._range(ann.beat_offsets, track_id)
+        return np.searchsorted(ann.beat_times[start:end], times, side='right') - 1
+
+    def bar_numbers_at(self, track_id, times):
+        """
+        Get the number of the bar containing each timestamp.
+
+        Args:
+            track_id: str - The ID of the track.
+
+            times: np.ndarray - The timestamps in seconds.
+
+        Return:
+            np.ndarray - The bar number at each timestamp, or 0 for timestamps before the first beat.
+        """
+        ann = self._annotations
+        start, end = self._range(ann.beat_offsets, track_id)
+        idxs = self.beat_indices_at(track_id, times)
+        if end == start:
+            return np.zeros(np.shape(idxs), dtype=ann.bar_numbers.dtype)
+        return np.where(idxs >= 0, ann.bar_numbers[start:end][np.maximum(idxs, 0)], 0)
+
+    def beat_segment_labels(self, track_id):
+        """
+        Get the label of the segment containing each beat of a track.
+
+        Args:
+            track_id: str - The ID of the track.
+
+        Return:
+            np.ndarray - The segment label for each beat in the track.
+        """
+        ann = self._annotations
+        start, end = self._range(ann.beat_offsets, track_id)
+        return self.segment_labels_at(track_id, ann.beat_times[start:end])
+
+    def _range(self, offsets, track_id):
+        """
+        Get the start and end position of a track within a set of offsets.
+        """
+        idx = self._annotations.track_index(track_id)
+        return offsets[idx], offsets[idx + 1]
@@ -0,0 +1,257 @@
+"""
+Created 10-17-26
+
+Readers for the Harmonix Set annotation text files, with optional parallelism and
+instrumentation of where load time is spent.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Python standard library imports
+import io
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+
+PARSERS = ['pandas', 'numpy']
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor
+}
+
+
+class LoadStats(object):
+    """
+    Timing statistics for a set of annotation files read from disk, separating the time
+    spent reading each file (I/O) from the time spent parsing its contents.
+
+    The wall time covers each bulk read of many files, from start to finish. Files read one at a
+    time, e.g., when a dataset is loaded lazily, add their own I/O and parse time instead, so for
+    those the wall time is the summed time of each file even if several were read concurrently.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._records = []
+        self._lock = threading.Lock()
+        self.wall_time = 0.0
+
+    def record(self, fname, num_bytes, io_time, parse_time, wall_time=0.0):
+        """
+        Adds the timing of a single file.
+
+        Args:
+            fname: str - The filename (with path) that was read.
+
+            num_bytes: int - The size of the file in bytes.
+
+            io_time: float - The time in seconds spent reading the file.
+
+            parse_time: float - The time in seconds spent parsing the file contents.
+
+            wall_time: float - The time in seconds to add to the wall time.
+        """
+        with self._lock:
+            self._records += [(fname, num_bytes, io_time, parse_time)]
+            self.wall_time += wall_time
+
+    def add_wall_time(self, wall_time):
+        """
+        Adds the wall time of a bulk read, whose files were recorded individually.
+
+        Args:
+            wall_time: float - The time in seconds to add to the wall time.
+        """
+        with self._lock:
+            self.wall_time += wall_time
+
+    @property
+    def num_files(self):
+        """
+        Get the number of files read.
+        """
+        return len(self._records)
+
+    @property
+    def io_time(self):
+        """
+        Get the total time in seconds spent reading files, summed over all files.
+        """
+        return sum(rec[2] for rec in self._records)
+
+    @property
+    def parse_time(self):
+        """
+        Get the total time in seconds spent parsing files, summed over all files.
+        """
+        return sum(rec[3] for rec in self._records)
+
+    @property
+    def files_per_second(self):
+        """
+        Get the load throughput, i.e., the number of files read per second of wall time.
+        """
+        return self.num_files / self.wall_time if self.wall_time > 0 else float('nan')
+
+    def slowest(self, num=10):
+        """
+        Get the files that took longest to load.
+
+        Args:
+            num: int - The number of files to return.
+
+        Return:
+            list(tuple(str, float, float)) - The filename, I/O time and parse time for the
+            slowest files, slowest first.
+        """
+        records = sorted(self._records, key=lambda rec: rec[2] + rec[3], reverse=True)
+        return [(rec[0], rec[2], rec[3]) for rec in records[:num]]
+
+    def __str__(self):
+        return '{} files in {:.3f}s ({:.1f} files/s), I/O: {:.3f}s, parse: {:.3f}s'.format(
+            self.num_files, self.wall_time, self.files_per_second, self.io_time, self.parse_time)
+
+
+def parse_beats(text, columns, parser='pandas'):
+    """
+    Parses the contents of a beats and downbeats annotation file.
+
+    Args:
+        text: str - The tab separated contents of the file.
+
+        columns: list(str) - The names of the beat time, beat number and bar number columns.
+
+        parser: str - One of `PARSERS`. "pandas" uses `pd.read_csv`, "numpy" is a fast-path
+        that splits the text directly into arrays.
+
+    Return:
+        pd.DataFrame - The beat data with the given column names.
+    """
+    if parser == 'pandas':
+        return pd.read_csv(io.StringIO(text), names=columns, delimiter='\t')
+    rows = np.array(text.split(), dtype=np.float64).reshape(-1, 3)
+    return pd.DataFrame({
+        columns[0]: rows[:, 0],
+        columns[1]: rows[:, 1].astype(np.int64),
+        columns[2]: rows[:, 2].astype(np.int64)
+    }, columns=columns)
+
+
+def parse_segments(text, columns, parser='pandas'):
+    """
+    Parses the contents of a segments annotation file.
+
+    Args:
+        text: str - The space separated contents of the file.
+
+        columns: list(str) - The names of the segment start and segment label columns.
+
+        parser: str - One of `PARSERS`. "pandas" uses `pd.read_csv`, "numpy" is a fast-path
+        that splits the text directly into arrays.
+
+    Return:
+        pd.DataFrame - The segment data with the given column names.
+    """
+    if parser == 'pandas':
+        return pd.read_csv(io.StringIO(text), names=columns, delimiter=' ')
+    rows = [line.split(' ', 1) for line in text.splitlines() if line.strip()]
+    return pd.DataFrame({
+        columns[0]: np.array([row[0] for row in rows], dtype=np.float64),
+        columns[1]: np.array([row[1] for row in rows], dtype=object)
+    }, columns=columns)
+
+
+def read_annotation_file(fname, parse_func, columns, parser='pandas', stats=None):
+    """
+    Reads and parses a single annotation file, timing the I/O and parsing separately.
+
+    Args:
+        fname: str - The filename (with path) of the annotation file.
+
+        parse_func: function - Either `parse_beats` or `parse_segments`.
+
+        columns: list(str) - The column names to pass to `parse_func`.
+
+        parser: str - One of `PARSERS`.
+
+        stats: LoadStats or None - If provided, the timing of this file is recorded here.
+
+    Return:
+        pd.DataFrame - The parsed annotation data.
+    """
+    data, num_bytes, io_time, parse_time = _timed_read(fname, parse_func, columns, parser)
+    if stats is not None:
+        stats.record(fname, num_bytes, io_time, parse_time, wall_time=io_time + parse_time)
+    return data
+
+
+def read_annotation_files(fnames, parse_func, columns, parser='pandas', num_workers=1, executor='thread', stats=None):
+    """
+    Reads and parses many annotation files, optionally in parallel.
+
+    Args:
+        fnames: list(str) - The filenames (with path) of the annotation files.
+
+        parse_func: function - Either `parse_beats` or `parse_segments`.
+
+        columns: list(str) - The column names to pass to `parse_func`.
+
+        parser: str - One of `PARSERS`.
+
+        num_workers: int - The number of threads or processes to read files with. If 1, files
+        are read one after another in the calling thread.
+
+        executor: str - One of the keys of `EXECUTORS`. Threads suit slow or network filesystems,
+        where most of the time is spent waiting on I/O, processes suit CPU bound parsing.
+
+        stats: LoadStats or None - If provided, the timing of every file, and the total wall time,
+        are recorded here.
+
+    Return:
+        dict(str, pd.DataFrame) - The parsed data for each filename, in the order of `fnames`.
+    """
+    start = time.perf_counter()
+    if num_workers > 1:
+        chunksize = max(1, len(fnames) // (4*num_workers))
+        with EXECUTORS[executor](num_workers) as pool:
+            results = list(pool.map(_timed_read, fnames, [parse_func]*len(fnames), [columns]*len(fnames),
+                                    [parser]*len(fnames), chunksize=chunksize))
+    else:
+        results = [_timed_read(fname, parse_func, columns, parser) for fname in fnames]
+
+    data = {}
+    for fname, (df, num_bytes, io_time, parse_time) in zip(fnames, results):
+        data[fname] = df
+        if stats is not None:
+            stats.record(fname, num_bytes, io_time, parse_time)
+    if stats is not None:
+        stats.add_wall_time(time.perf_counter() - start)
+    return data
+
+
+def _timed_read(fname, parse_func, columns, parser):
+    """
+    Reads and parses a single annotation file.
+
+    Return:
+        tuple(pd.DataFrame, int, float, float) - The parsed data, the size of the file in bytes,
+        and the time spent reading and parsing the file in seconds.
+    """
+    start = time.perf_counter()
+    with open(fname, 'rb') as f:
+        raw = f.read()
+    io_time = time.perf_counter() - start
+    start = time.perf_counter()
+    data = parse_func(raw.decode('utf-8'), columns, parser)
+    parse_time = time.perf_counter() - start
+    return data, len(raw), io_time, parse_time
@@ -0,0 +1,206 @@
+"""
+Created 10-17-26
+
+An on-disk cache of decoded mp3 audio, shared between estimators, runs and worker processes.
+
+Decoded samples are stored as `.npy` files keyed by a hash of the mp3 content and the decode
+parameters, and memory-mapped on read. The total size of the cache is bounded, evicting the
+least recently used entries first.
+"""
+
+
+# Local imports
+from audio_utils import mp3_get_samples
+from audio_utils import resample_samples
+from audio_utils import WAV_SAMP_RATE
+from pipeline_trace import stage
+
+# Third party imports
+import numpy as np
+
+# Python standard library imports
+import os
+import fcntl
+import hashlib
+import time
+import tempfile
+from contextlib import contextmanager
+
+
+DEFAULT_MAX_BYTES = 50*1024**3
+HASH_CHUNK_SIZE = 1024**2
+# Entries are locked in stripes, by the first characters of their key, to bound the number of lock files.
+LOCK_STRIPE_CHARS = 2
+# Temporary files older than this are left over from a process that died while writing them.
+STALE_TMP_SECONDS = 3600
+_LOCK_FILE = '.lock'
+_ENTRY_EXT = '.npy'
+
+
+class DecodedAudioCache(object):
+    """
+    A size-bounded, least recently used cache of decoded audio on disk. Safe for concurrent use by
+    multiple processes: entries are written atomically, each track is only decoded by one process at a
+    time, and eviction is serialized with a lock file.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Constructor.
+
+        Args:
+            cache_dir: str - The directory in which to store decoded audio.
+
+            max_bytes: int - The maximum total size of the cached audio in bytes.
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock_dir = os.path.join(self.cache_dir, 'locks')
+        os.makedirs(self._lock_dir, exist_ok=True)
+
+    def get(self, mp3_fname, dtype=np.float32, sample_rate=WAV_SAMP_RATE):
+        """
+        Get the decoded samples of an mp3 file, decoding and caching them if not yet cached. Samples at
+        a sample rate other than the decoder's are resampled from the cached decode, so each track is only
+        decoded once whichever rates its consumers need.
+
+        Args:
+            mp3_fname: str - The filename (with path) of the mp3 file.
+
+            dtype: np.dtype - The sample type, see `audio_utils.mp3_get_samples`.
+
+            sample_rate: int - The sample rate in Hz.
+
+        Return:
+            np.ndarray - A read-only, memory-mapped array of shape (channels, samples) containing the
+            audio sample data.
+        """
+        with stage('audio_cache'):
+            return self._get(mp3_fname, dtype, sample_rate)
+
+    def _get(self, mp3_fname, dtype, sample_rate):
+        """
+        Get the decoded samples of an mp3 file, see `get`.
+        """
+        entry = os.path.join(self.cache_dir, self.key(mp3_fname, dtype, sample_rate) + _ENTRY_EXT)
+        samples = self._load(entry)
+        if samples is not None:
+            return samples
+
+        # NOTE: The decode is fetched before locking, as it shares a lock stripe with this entry.
+        decoded = self.get(mp3_fname, np.float32) if sample_rate != WAV_SAMP_RATE else None
+
+        with self._lock(os.path.join(self._lock_dir, os.path.basename(entry)[:LOCK_STRIPE_CHARS] + _LOCK_FILE)):
+            # Another process may have decoded this track while we waited for the lock.
+            samples = self._load(entry)
+            if samples is None:
+                if decoded is not None:
+                    samples = resample_samples(decoded, WAV_SAMP_RATE, sample_rate, dtype)
+                else:
+                    with open(mp3_fname, 'rb') as mp3_file:
+                        samples = mp3_get_samples(mp3_file, dtype=dtype)
+                if samples.size == 0:
+                    raise Exception('No audio decoded from mp3 file: {}'.format(mp3_fname))
+                fd, tmp_fname = tempfile.mkstemp(prefix='tmp', suffix=_ENTRY_EXT, dir=self.cache_dir)
+                try:
+                    with os.fdopen(fd, 'wb') as tmp_file:
+                        np.save(tmp_file, samples)
+                    os.replace(tmp_fname, entry)
+                except BaseException:
+                    os.remove(tmp_fname)
+                    raise
+                samples = self._load(entry)
+
+        self.evict(keep=entry)
+        return samples
+
+    def key(self, mp3_fname, dtype=np.float32, sample_rate=WAV_SAMP_RATE):
+        """
+        Get the cache key for an mp3 file and decode parameters.
+
+        Args:
+            mp3_fname: str - The filename (with path) of the mp3 file.
+
+            dtype: np.dtype - The sample type.
+
+            sample_rate: int - The sample rate in Hz.
+
+        Return:
+            str - A key combining a hash of the mp3 file content with the decode parameters.
+        """
+        digest = hashlib.sha1()
+        with open(mp3_fname, 'rb') as mp3_file:
+            for chunk in iter(lambda: mp3_file.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return '{}-{}-{}'.format(digest.hexdigest(), sample_rate, np.dtype(dtype).name)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the total size of the cache is within `max_bytes`,
+        along with any temporary files left behind by processes that died while writing an entry.
+
+        Args:
+            keep: str or None - The path of an entry never to remove, e.g., one that was just added, such
+            that an entry larger than `max_bytes` is still cached until the next entry is added.
+        """
+        with self._lock(os.path.join(self.cache_dir, _LOCK_FILE)):
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(_ENTRY_EXT) or entry.path == keep:
+                    continue
+                try:
+                    stat = entry.stat()
+                    if entry.name.startswith('tmp'):
+                        if now - stat.st_mtime > STALE_TMP_SECONDS:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries += [(stat.st_mtime, stat.st_size, entry.path)]
+
+            # Remove the per-entry lock files of earlier versions of the cache, now replaced by stripes
+            for entry in os.scandir(self._lock_dir):
+                if len(entry.name) > LOCK_STRIPE_CHARS + len(_LOCK_FILE):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+            total_bytes = sum(entry[1] for entry in entries)
+            if keep is not None and os.path.exists(keep):
+                total_bytes += os.path.getsize(keep)
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+
+    def _load(self, entry):
+        """
+        Memory-maps a cache entry, marking it as recently used.
+
+        Return:
+            np.ndarray or None - The cached samples, or None if the entry does not exist.
+        """
+        try:
+            samples = np.load(entry, mmap_mode='r')
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return samples
+
+    @contextmanager
+    def _lock(self, lock_fname):
+        """
+        Holds an exclusive, inter-process lock on a file for the duration of the context.
+        """
+        with open(lock_fname, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
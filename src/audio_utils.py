@@ -4,17 +4,22 @@ Created 10-13-19 by Matt C. McCallum
 
 
 # Local imports
-# None.
+from pipeline_trace import stage
 
 # Third party imports
 from mutagen import mp3
 import numpy as np
+import scipy.signal
 
 # Python standard library imports
-import struct
+import os
 import io
 import wave
-from subprocess import Popen, PIPE
+import tempfile
+import threading
+from math import gcd
+from contextlib import contextmanager
+from subprocess import Popen, PIPE, DEVNULL
 
 
 # Set some wav parameters to convert to when reading from mp3.
@@ -22,30 +27,220 @@ WAV_BIT_DEPTH = 16
 WAV_SAMP_RATE = 44100
 WAV_FFMPEG_FMT = 'pcm_s' + str(WAV_BIT_DEPTH) + 'le'
 
+# Raw PCM formats that ffmpeg can decode to directly, by numpy dtype.
+PCM_FFMPEG_FMTS = {
+    np.dtype(np.int16): ('s16le', 'pcm_s16le'),
+    np.dtype(np.int32): ('s32le', 'pcm_s32le'),
+    np.dtype(np.float32): ('f32le', 'pcm_f32le'),
+    np.dtype(np.float64): ('f64le', 'pcm_f64le')
+}
 
-def wav_packing_string(num_frames, num_channels, bit_depth):
+# The number of samples per channel in each block when streaming decoded audio,
+# and the number of bytes of mp3 data to feed to the decoder at a time.
+DEFAULT_BLOCK_SIZE = 65536
+FEED_CHUNK_SIZE = 65536
+
+# The window of the anti-aliasing filter used when resampling. A Kaiser window with a beta of 10 keeps the
+# error on a full-scale tone around 1e-6, versus around 1e-3 with scipy's default beta of 5.
+RESAMPLE_WINDOW = ('kaiser', 10.0)
+
+# The number of mp3 frames decoded, and discarded, ahead of an excerpt, such that the decoder's bit reservoir
+# and overlap are filled by the time it reaches the excerpt. Low bitrate, e.g., 32kbps, tracks need around 8.
+EXCERPT_PREROLL_FRAMES = 16
+
+# The delay of the mp3 decoder in samples, skipped by ffmpeg along with the encoder delay given in a LAME header.
+MP3_DECODER_DELAY = 529
+
+# A memory backed directory for the temporary wav files of tools that can only read audio by filename.
+TMPFS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class AudioSignal(object):
+    """
+    Decoded audio held in memory, as passed to estimators in place of an audio filename.
+    """
+
+    def __init__(self, samples, sample_rate=WAV_SAMP_RATE, filename=None, resampled=None):
+        """
+        Constructor.
+
+        Args:
+            samples: np.ndarray - An array of shape (channels, samples) of int16 samples, e.g., as
+            returned by `mp3_get_samples`.
+
+            sample_rate: int - The sample rate of the audio in Hz.
+
+            filename: str or None - The filename (with path) of the file the audio was decoded from.
+
+            resampled: dict(int, np.ndarray) or None - The audio already resampled to other sample rates,
+            e.g., by the decoder, as would be returned by `resampled`.
+        """
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.filename = filename
+        self._resampled = dict(resampled or {})
+
+    @property
+    def num_channels(self):
+        """
+        Get the number of channels in the audio, e.g., 2 for stereo.
+        """
+        return self.samples.shape[0]
+
+    @property
+    def frames(self):
+        """
+        Get the samples in the layout in which they are read from a wav file, e.g., by madmom's `Signal`.
+
+        Return:
+            np.ndarray - An array of shape (samples,) for mono audio, or (samples, channels) otherwise.
+        """
+        return self.samples[0] if self.num_channels == 1 else self.samples.T
+
+    def to_madmom(self):
+        """
+        Get the audio as a madmom `Signal`, as madmom would read it from a wav file.
+
+        Return:
+            madmom.audio.signal.Signal - The audio signal.
+        """
+        # NOTE: Imported here so that madmom is only required by the estimators that use it.
+        from madmom.audio.signal import Signal
+        return Signal(self.frames, sample_rate=self.sample_rate)
+
+    def to_float(self):
+        """
+        Get the samples as floating point values in the range [-1.0, 1.0], as read by librosa.
+
+        Return:
+            np.ndarray - An array of shape (channels, samples) of float32 samples.
+        """
+        return self.samples.astype(np.float32) / float(2**(WAV_BIT_DEPTH - 1))
+
+    def resampled(self, sample_rate):
+        """
+        Get the audio at another sample rate, resampling it on first request. Each consumer of the audio can
+        thereby take its own sample rate from a single decode.
+
+        Args:
+            sample_rate: int - The sample rate in Hz.
+
+        Return:
+            np.ndarray - An array of shape (channels, samples) of float32 samples in the range [-1.0, 1.0].
+        """
+        if sample_rate not in self._resampled:
+            self._resampled[sample_rate] = resample_samples(self.samples, self.sample_rate, sample_rate)
+        return self._resampled[sample_rate]
+
+    @contextmanager
+    def as_wav_file(self, tmp_dir=TMPFS_DIR):
+        """
+        Writes the audio to a temporary wav file for the duration of the context, for tools that cannot
+        read audio from memory.
+
+        Args:
+            tmp_dir: str or None - The directory in which to create the file, by default a memory backed
+            file system where available.
+
+        Return:
+            str - The filename (with path) of the wav file.
+        """
+        with tempfile.NamedTemporaryFile(mode='wb', suffix='.wav', prefix='tmp', dir=tmp_dir) as wav_file:
+            with stage('wav_write'):
+                samples_to_wav(self.samples, wav_file)
+                wav_file.flush()
+            yield wav_file.name
+
+
+def mp3_num_channels(mp3_source_file):
     """
-    Get the string for packing or unpacking a given number of frames using the struct module.
+    Reads the number of channels from the header of an mp3 file, leaving the file at its start.
 
     Args:
-        num_frames: int - The number of frames to cover in the packing string
+        mp3_source_file: file-like - A seekable file-like object containing mp3 data.
 
-        num_channels: int - The number of channels in the audio, e.g., 2 for stereo.
+    Return:
+        int - The number of channels in the audio, e.g., 2 for stereo.
+    """
+    with stage('mp3_header'):
+        n_channels = mp3.MP3(mp3_source_file).info.channels
+        mp3_source_file.seek(0)
+    return n_channels
 
-        bit_depth: int - The number of bits per sample.
+
+def ffmpeg_decode_command(n_channels, dtype=np.float32):
+    """
+    Get the ffmpeg command line that decodes mp3 data from stdin to raw, interleaved PCM samples on stdout.
+
+    Args:
+        n_channels: int - The number of channels in the mp3 data.
+
+        dtype: np.dtype - The sample type, one of float32, float64, int16 or int32.
 
     Return:
-        str - The string to be used with the struct module for unpacking, packing the given number of frames for the
-        current audio format described in this object.
-    """
-    unpack_fmt = '<%i' % ( num_frames * num_channels )
-    if bit_depth == 16:
-        unpack_fmt += 'h'
-    elif bit_depth == 32:
-        unpack_fmt += 'i'
-    else:
-        raise Exception('Unsupporeted bit depth format for packing data.')
-    return unpack_fmt
+        list(str) - The command and its arguments.
+    """
+    raw_fmt, codec = PCM_FFMPEG_FMTS[np.dtype(dtype)]
+    return ["ffmpeg", "-loglevel", "panic", "-f", "mp3", "-i", "pipe:0", "-map_metadata", "-1", "-vn", "-acodec", codec, "-ac",
+            str(n_channels), "-ar", str(WAV_SAMP_RATE), "-f", raw_fmt, 'pipe:1']
+
+
+def mp3_stream_samples(mp3_source_file, block_size=DEFAULT_BLOCK_SIZE, dtype=np.float32, n_channels=None):
+    """
+    Decodes an mp3 file incrementally, yielding fixed-size blocks of samples as ffmpeg produces them.
+    The mp3 data is fed to ffmpeg in chunks from a background thread, so that peak memory usage
+    depends on the block size rather than the length of the track.
+
+    Args:
+        mp3_source_file: file-like - A file-like object containing mp3 data.
+
+        block_size: int or None - The number of samples (per channel) in each block. The final block
+        may be shorter. If None, the whole track is decoded and yielded as a single read-only block.
+
+        dtype: np.dtype - The sample type, one of float32, float64, int16 or int32. Floating point
+        samples are in the range [-1.0, 1.0], integer samples span the full range of the type.
+
+        n_channels: int or None - The number of channels in the mp3 data, if already known. If None,
+        it is read from the mp3 header.
+
+    Return:
+        generator(np.ndarray) - Arrays of shape (channels, samples) containing consecutive blocks of the
+        audio sample data. Each is a transposed view of ffmpeg's interleaved output, without copies.
+    """
+    dtype = np.dtype(dtype)
+    if n_channels is None:
+        n_channels = mp3_num_channels(mp3_source_file)
+
+    # Decode
+    p = Popen(ffmpeg_decode_command(n_channels, dtype), stdout=PIPE, stderr=DEVNULL, stdin=PIPE)
+    feeder = threading.Thread(target=_feed_stdin, args=(mp3_source_file, p.stdin), daemon=True)
+    feeder.start()
+
+    try:
+        if block_size is None:
+            data = p.stdout.read()
+            # NOTE: Checked before yielding, as callers taking the single block do not resume the generator.
+            _check_exit(p)
+            yield np.frombuffer(data, dtype=dtype).reshape(-1, n_channels).T
+        else:
+            block_bytes = block_size*n_channels*dtype.itemsize
+            while True:
+                block = bytearray(block_bytes)
+                num_read = _read_fully(p.stdout, block)
+                if num_read == 0:
+                    break
+                num_read -= num_read % (n_channels*dtype.itemsize)
+                yield np.frombuffer(block, dtype=dtype, count=num_read // dtype.itemsize).reshape(-1, n_channels).T
+                if num_read < block_bytes:
+                    break
+            _check_exit(p)
+    finally:
+        # Release ffmpeg if the consumer stopped early
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        p.stdout.close()
+        feeder.join()
 
 
 def mp3_to_wav(mp3_source_file):
@@ -58,56 +253,288 @@ def mp3_to_wav(mp3_source_file):
     Return:
         file-like - A file-like object containing wav data.
     """
-    n_channels = mp3.MP3(mp3_source_file).info.channels
-    mp3_source_file.seek(0)
+    n_channels = mp3_num_channels(mp3_source_file)
 
-    # Decode
-    p = Popen(["ffmpeg", "-loglevel", "panic", "-f", "mp3", "-i", "pipe:0", "-map_metadata", "-1", "-vn", "-acodec", WAV_FFMPEG_FMT, "-ac",
-            str(n_channels), "-ar", str(WAV_SAMP_RATE), "-f", "wav", 'pipe:1'], stdout=PIPE, stderr=PIPE, stdin=PIPE)
-    in_mem_file = io.BytesIO(p.communicate(input=mp3_source_file.read())[0])
-
-    # Fix file size as ffmpeg output via std stream doesn't include a file size.
-    in_mem_file.seek(0)
-    file_length = in_mem_file.seek(0, 2)
-    in_mem_file.seek(4)
-    in_mem_file.write(struct.pack('i', file_length - 8))
-    in_mem_file.seek(0)
-    test_data = in_mem_file.read(10000)
-    data_start = test_data.find(b'data')
-    in_mem_file.seek(data_start + 4)
-    in_mem_file.write(struct.pack('i', file_length - data_start - 8))
+    in_mem_file = io.BytesIO()
+    _write_wav(in_mem_file, n_channels, mp3_stream_samples(mp3_source_file, dtype=np.int16, n_channels=n_channels))
     in_mem_file.seek(0)
 
     return in_mem_file
 
 
-def mp3_get_samples(mp3_source_file):
+def samples_to_wav(samples, wav_out_file):
+    """
+    Writes audio samples to a wav file, in the same format as produced by `mp3_to_wav`.
+
+    Args:
+        samples: np.ndarray - An array of shape (channels, samples) of int16 samples.
+
+        wav_out_file: file-like - A writable, seekable file-like object to write the wav data to.
+    """
+    _write_wav(wav_out_file, samples.shape[0], [samples])
+
+
+def mp3_get_samples(mp3_source_file, dtype=np.float32):
     """
     Reads samples from an mp3 file as a numpy array of floats, with channels along the first
     axis and samples along the second axis.
 
+    The audio is decoded by ffmpeg straight to raw PCM samples of the requested type, and the
+    output buffer is reinterpreted as an array without copying or unpacking it. As such, the
+    returned array is a read-only, transposed view of ffmpeg's interleaved output.
+
+    Args:
+        mp3_source_file: file-like - A file-like object containing mp3 data.
+
+        dtype: np.dtype - The sample type, one of float32, float64, int16 or int32. Floating point
+        samples are in the range [-1.0, 1.0], integer samples span the full range of the type.
+
+    Return:
+        np.ndarray - A read-only array of shape (channels, samples) containing the audio sample data.
+    """
+    with stage('decode'):
+        return next(mp3_stream_samples(mp3_source_file, block_size=None, dtype=dtype))
+
+
+def mp3_get_excerpt(mp3_source_file, start, end, dtype=np.float32):
+    """
+    Reads the samples of the [start, end) window of an mp3 file, decoding only the mp3 frames that span it.
+    The excerpt is sample accurate, i.e., identical to the same window of the samples returned by
+    `mp3_get_samples`.
+
+    The frames are located by reading their headers, and the decoder is started a number of frames ahead
+    of the window, see `EXCERPT_PREROLL_FRAMES`. Tracks at a sample rate other than `WAV_SAMP_RATE` are
+    resampled by the decoder, such that their samples do not map onto whole frames, and are decoded in
+    full instead.
+
+    Args:
+        mp3_source_file: file-like - A seekable file-like object containing mp3 data.
+
+        start: float - The start of the window in seconds.
+
+        end: float - The end of the window in seconds.
+
+        dtype: np.dtype - The sample type, see `mp3_get_samples`.
+
+    Return:
+        np.ndarray - A read-only array of shape (channels, samples) containing the audio sample data, with
+        `round(end*WAV_SAMP_RATE) - round(start*WAV_SAMP_RATE)` samples, or fewer if the track ends first.
+    """
+    first = max(int(round(start*WAV_SAMP_RATE)), 0)
+    last = max(int(round(end*WAV_SAMP_RATE)), first)
+    info = mp3.MP3(mp3_source_file).info
+    mp3_source_file.seek(0)
+    if info.sample_rate != WAV_SAMP_RATE:
+        return mp3_get_samples(mp3_source_file, dtype=dtype)[:, first:last]
+
+    offsets, frame_samples, skip = _mp3_frame_offsets(mp3_source_file, info.frame_offset, last)
+    if offsets[-1] is None:
+        # The track ends within the window
+        offsets.pop()
+        last = min(last, (len(offsets) - 1)*frame_samples - skip)
+        first = min(first, last)
+
+    # Decode from a few frames ahead of the window, or from the start of the file, headers included, if the
+    # window is near the start. The decoder only skips the delay in the latter case.
+    start_frame = (first + skip) // frame_samples - EXCERPT_PREROLL_FRAMES
+    end_frame = min(-(-(last + skip) // frame_samples), len(offsets) - 1)
+    if start_frame > 0:
+        start_byte, offset = offsets[start_frame], start_frame*frame_samples - skip
+    else:
+        start_byte, offset = 0, 0
+    mp3_source_file.seek(start_byte)
+    frames = io.BytesIO(mp3_source_file.read(offsets[end_frame] - start_byte))
+    mp3_source_file.seek(0)
+
+    samples = next(mp3_stream_samples(frames, block_size=None, dtype=dtype, n_channels=info.channels))
+    return samples[:, first - offset:last - offset]
+
+
+def mp3_get_multirate_samples(mp3_source_file, sample_rates, dtype=np.float32):
+    """
+    Reads samples from an mp3 file at several sample rates, decoding it only once and resampling the
+    decoded audio to each of the other rates, see `resample_samples`.
+
     Args:
         mp3_source_file: file-like - A file-like object containing mp3 data.
 
+        sample_rates: list(int) - The sample rates in Hz.
+
+        dtype: np.dtype - The sample type, see `mp3_get_samples`.
+
     Return:
-        np.ndarray - An array of shape (channels, samples) containing the audio sample data as
-        floats in the range [-1.0, 1.0]
+        dict(int, np.ndarray) - For each sample rate, an array of shape (channels, samples) containing
+        the audio sample data.
+    """
+    resampling = any(sample_rate != WAV_SAMP_RATE for sample_rate in sample_rates)
+    samples = mp3_get_samples(mp3_source_file, dtype=np.float32 if resampling else dtype)
+    return {sample_rate: resample_samples(samples, WAV_SAMP_RATE, sample_rate, dtype) for sample_rate in sample_rates}
+
+
+def resample_samples(samples, orig_sample_rate, sample_rate, dtype=np.float32):
     """
-    # First get the number of channels for later
-    n_channels = mp3.MP3(mp3_source_file).info.channels
+    Resamples audio with a polyphase anti-aliasing filter, by the exact rational ratio of the two sample
+    rates, e.g., 160/294 from 44100Hz to 24000Hz.
 
-    # Get an in memory wav object
-    in_mem_file = mp3_to_wav(mp3_source_file)
+    Args:
+        samples: np.ndarray - An array of shape (channels, samples) of integer or floating point samples.
+
+        orig_sample_rate: int - The sample rate of `samples` in Hz.
+
+        sample_rate: int - The sample rate to resample to in Hz.
 
-    # Read in wav data
-    audio = wave.open(in_mem_file, 'rb')
-    num_frames = audio.getnframes()
-    data = audio.readframes( num_frames )
-    audio.close()
-    data = struct.unpack( wav_packing_string( num_frames, n_channels, WAV_BIT_DEPTH ), data )
+        dtype: np.dtype - The sample type to return. Floating point samples are in the range [-1.0, 1.0],
+        integer samples span the full range of the type.
 
-    return_array = np.zeros( ( n_channels, num_frames ) )
-    for channel in range( n_channels ):
-        return_array[channel,:] = np.array( data[channel::n_channels] )/( 2.0**WAV_BIT_DEPTH )
+    Return:
+        np.ndarray - An array of shape (channels, samples) containing the resampled audio. If the sample
+        rates and types match, this is `samples` itself.
+    """
+    dtype = np.dtype(dtype)
+    if orig_sample_rate == sample_rate and samples.dtype == dtype:
+        return samples
+    with stage('resample'):
+        if np.issubdtype(samples.dtype, np.integer):
+            samples = samples.astype(np.float32) / float(np.iinfo(samples.dtype).max + 1)
+        if orig_sample_rate != sample_rate:
+            factor = gcd(orig_sample_rate, sample_rate)
+            samples = scipy.signal.resample_poly(samples, sample_rate // factor, orig_sample_rate // factor, axis=-1,
+                                                  window=RESAMPLE_WINDOW)
+        if np.issubdtype(dtype, np.integer):
+            scale = np.iinfo(dtype).max + 1
+            return np.clip(np.round(samples*scale), -scale, scale - 1).astype(dtype)
+        return samples.astype(dtype, copy=False)
 
-    return return_array
+
+def _mp3_frame_offsets(mp3_source_file, frame_offset, num_samples):
+    """
+    Reads the byte offsets of the audio frames of an mp3 file from their headers, up to those decoding to
+    a given number of samples.
+
+    Args:
+        mp3_source_file: file-like - A seekable file-like object containing mp3 data.
+
+        frame_offset: int - The byte offset of the first frame, e.g., as found by `mutagen`.
+
+        num_samples: int - The number of decoded samples, as returned by `mp3_get_samples`, that the frames
+        should span.
+
+    Return:
+        list(int) - The byte offset of each audio frame, followed by that of the end of the last frame, and
+        None if the track ends before `num_samples`.
+
+        int - The number of samples per channel in each frame.
+
+        int - The number of samples at the start of the decoded frames that are skipped by the decoder. The
+        padding at their end is not skipped when decoding from a pipe.
+    """
+    mp3_source_file.seek(frame_offset)
+    frame = mp3.MPEGFrame(mp3_source_file)
+    frame_samples = {1: 384, 2: 1152, 3: 1152 if frame.version == 1 else 576}[frame.layer]
+    skip = 0
+    if frame.sketchy:
+        # An audio frame rather than a header frame
+        mp3_source_file.seek(frame_offset)
+    else:
+        mp3_source_file.seek(frame_offset + mp3.XingHeader.get_offset(frame))
+        encoder_delay = _lame_encoder_delay(mp3_source_file)
+        if encoder_delay is not None:
+            skip = encoder_delay + MP3_DECODER_DELAY
+        # Skip the header frame
+        mp3_source_file.seek(frame_offset)
+        mp3.MPEGFrame(mp3_source_file)
+
+    offsets = []
+    # One frame is read beyond the samples needed, for the end of the last frame
+    while (len(offsets) - 1)*frame_samples - skip < num_samples:
+        offsets += [mp3_source_file.tell()]
+        try:
+            mp3.MPEGFrame(mp3_source_file)
+        except mp3.HeaderNotFoundError:
+            offsets += [None]
+            break
+    return offsets, frame_samples, skip
+
+
+def _lame_encoder_delay(mp3_source_file):
+    """
+    Reads the encoder delay from the LAME extension of a Xing or Info header, as ffmpeg does, i.e., for the
+    tags written by LAME or ffmpeg itself.
+
+    Args:
+        mp3_source_file: file-like - A file-like object positioned at the start of the Xing or Info header.
+
+    Return:
+        int or None - The number of samples of delay at the start of the decoded audio, or None if the header
+        or its LAME extension is missing.
+    """
+    header = mp3_source_file.read(8)
+    if len(header) != 8 or header[:4] not in (b'Xing', b'Info'):
+        return None
+    flags = int.from_bytes(header[4:], 'big')
+    # The frame count, byte count, table of contents and quality fields, as present
+    mp3_source_file.seek(sum(size for flag, size in ((1, 4), (2, 4), (4, 100), (8, 4)) if flags & flag), 1)
+    extension = mp3_source_file.read(24)
+    if len(extension) != 24 or extension[:4] not in (b'LAME', b'Lavf', b'Lavc'):
+        return None
+    # The delay and padding are packed in 12 bits each
+    return int.from_bytes(extension[21:24], 'big') >> 12
+
+
+def _write_wav(wav_out_file, n_channels, blocks):
+    """
+    Writes blocks of int16 samples, each of shape (channels, samples), to a wav file.
+    """
+    wav_file = wave.open(wav_out_file, 'wb')
+    wav_file.setnchannels(n_channels)
+    wav_file.setsampwidth(WAV_BIT_DEPTH // 8)
+    wav_file.setframerate(WAV_SAMP_RATE)
+    for block in blocks:
+        wav_file.writeframesraw(np.ascontiguousarray(block.T, dtype=np.int16).tobytes())
+    # NOTE: Closing patches the RIFF and data chunk sizes in the header.
+    wav_file.close()
+
+
+def _check_exit(p):
+    """
+    Waits for an ffmpeg process to exit, raising an exception if it failed.
+    """
+    if p.wait() != 0:
+        raise Exception('ffmpeg failed to decode mp3 data, exit code: {}'.format(p.returncode))
+
+
+def _feed_stdin(source_file, stdin):
+    """
+    Copies a file-like object into a subprocess' stdin in chunks, closing stdin when done.
+    """
+    try:
+        while True:
+            chunk = source_file.read(FEED_CHUNK_SIZE)
+            if not chunk:
+                break
+            stdin.write(chunk)
+    except (BrokenPipeError, ValueError):
+        # The subprocess exited or was killed before consuming all of its input.
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _read_fully(stream, buffer):
+    """
+    Reads from a stream into a buffer until the buffer is full or the stream ends.
+
+    Return:
+        int - The number of bytes read.
+    """
+    view = memoryview(buffer)
+    num_read = 0
+    while num_read < len(buffer):
+        count = stream.readinto(view[num_read:])
+        if not count:
+            break
+        num_read += count
+    return num_read
@@ -6,6 +6,7 @@ Created by Oriol Nieto.
 
 import argparse
 import glob
+import itertools
 import json
 import os
 import time
@@ -15,11 +16,15 @@ from pqdm.processes import pqdm
 
 import librosa
 
+from audio_utils import AudioSignal
+from decode_pipeline import iter_decoded
+
 
 INPUT_DIR = "mp3s"
 OUTPUT_DIR = "audio_features"
 OUT_JSON = "info.json"
 N_JOBS = 12
+DECODE_AHEAD = 0
 
 # Features params
 SR = 24000
@@ -52,9 +57,17 @@ def compute_melspecs(audio):
 
 
 def compute_all_features(mp3_file, output_dir):
-    """Computes all the audio features."""
+    """Computes all the audio features.
+
+    `mp3_file` is either the path to an mp3 file, or its audio already decoded
+    as an `AudioSignal`."""
     # Decode and read mp3
-    audio, _ = librosa.load(mp3_file, sr=SR)
+    if isinstance(mp3_file, AudioSignal):
+        # Equivalent to `librosa.load`, which mixes down to mono and resamples
+        audio = librosa.to_mono(mp3_file.resampled(SR))
+        mp3_file = mp3_file.filename
+    else:
+        audio, _ = librosa.load(mp3_file, sr=SR)
 
     # Compute mels
     mel = compute_melspecs(audio)
@@ -115,6 +128,15 @@ if __name__ == "__main__":
         type=int,
         help="Number of jobs to run in parallel.",
     )
+    parser.add_argument(
+        "-d",
+        "--decode_ahead",
+        default=DECODE_AHEAD,
+        action="store",
+        type=int,
+        help="Number of mp3s to decode ahead of the feature computation "
+        "(0 decodes each mp3 in its own job).",
+    )
 
     args = parser.parse_args()
     start_time = time.time()
@@ -127,14 +149,25 @@ if __name__ == "__main__":
     mp3s = glob.glob(os.path.join(args.input_dir, "*.mp3"))
 
     # Compute features for each mp3 in parallel
-    pqdm_args = [[mp3_file, args.output_dir] for mp3_file in mp3s]
-
-    pqdm(
-        pqdm_args,
-        compute_all_features,
-        n_jobs=args.n_jobs,
-        argument_type="args",
-    )
+    if args.decode_ahead > 0:
+        # pqdm submits all of its arguments at once, so decoded audio is
+        # handed over one batch at a time to bound how much is held in memory
+        decoded = (fname if isinstance(signal, Exception) else signal
+                   for fname, signal in iter_decoded(mp3s, args.decode_ahead,
+                                                   sample_rates=[SR]))
+        batches = iter(lambda: list(itertools.islice(decoded, args.n_jobs)), [])
+    else:
+        batches = [mp3s]
+
+    for batch in batches:
+        pqdm_args = [[mp3_file, args.output_dir] for mp3_file in batch]
+
+        pqdm(
+            pqdm_args,
+            compute_all_features,
+            n_jobs=args.n_jobs,
+            argument_type="args",
+        )
 
     # Save parameters
     save_params(args.output_dir)
@@ -16,17 +16,21 @@ from joblib import Parallel, delayed
 
 import madmom
 from madmom.processors import ParallelProcessor, SequentialProcessor
-from madmom.audio.signal import SignalProcessor, FramedSignalProcessor
+from madmom.audio.signal import Signal, SignalProcessor, FramedSignalProcessor
 from madmom.audio.stft import ShortTimeFourierTransformProcessor
 from madmom.audio.spectrogram import (
     FilteredSpectrogramProcessor, LogarithmicSpectrogramProcessor,
     SpectrogramDifferenceProcessor)
 
+from audio_utils import AudioSignal
+from decode_pipeline import iter_decoded
+
 
 INPUT_DIR = "mp3s"
 OUTPUT_DIR = "madmom_features"
 OUT_JSON = "info.json"
 N_JOBS = 12
+DECODE_AHEAD = 0
 
 # Features params
 SR = 44100
@@ -39,7 +43,15 @@ DIFF_RATIO = 0.5
 
 
 def compute_all_features(mp3_file, output_dir):
-    """Computes all the audio features."""
+    """Computes all the audio features.
+
+    `mp3_file` is either the path to an mp3 file, or its audio already decoded
+    as an `AudioSignal`."""
+    audio = mp3_file
+    if isinstance(mp3_file, AudioSignal):
+        audio = Signal(mp3_file.frames, sample_rate=mp3_file.sample_rate)
+        mp3_file = mp3_file.filename
+
     sig = SignalProcessor(num_channels=1, sample_rate=SR)
 
     # process the multi-resolution spec & diff in parallel
@@ -60,7 +72,7 @@ def compute_all_features(mp3_file, output_dir):
     pre_processor = SequentialProcessor((sig, multi, np.hstack))
 
     # Compute mels
-    feat = pre_processor(mp3_file)
+    feat = pre_processor(audio)
 
     # Save
     out_file = os.path.join(
@@ -107,6 +119,13 @@ if __name__ == "__main__":
                         action="store",
                         type=int,
                         help="Number of jobs to run in parallel.")
+    parser.add_argument("-d",
+                        "--decode_ahead",
+                        default=DECODE_AHEAD,
+                        action="store",
+                        type=int,
+                        help="Number of mp3s to decode ahead of the feature "
+                        "computation (0 decodes each mp3 in its own job).")
 
     args = parser.parse_args()
     start_time = time.time()
@@ -118,7 +137,11 @@ if __name__ == "__main__":
     # Read mp3s
     mp3s = glob.glob(os.path.join(args.input_dir, "*.mp3"))
 
-    # Compute features for each mp3 in parallel
+    # Compute features for each mp3 in parallel, consuming the decoded audio
+    # only as fast as the jobs are dispatched
+    if args.decode_ahead > 0:
+        mp3s = (fname if isinstance(signal, Exception) else signal
+                for fname, signal in iter_decoded(mp3s, args.decode_ahead))
     Parallel(n_jobs=args.n_jobs)(
         delayed(compute_all_features)(mp3_file, args.output_dir)
         for mp3_file in mp3s)
@@ -0,0 +1,298 @@
+"""
+Created 10-17-26
+
+Descriptive statistics of the Harmonix Set annotations, as plotted in the Dataset Analysis
+notebook, computed in vectorized passes over the packed annotations of every track.
+
+Statistics are kept per track, so that when tracks are added to, or modified in, the dataset
+only those tracks need to be recomputed.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Python standard library imports
+import hashlib
+
+
+END_LABEL = 'end'
+TRACK_COLUMNS = [
+    'Num Segments',
+    'Num Unique Labels',
+    'Beat Length Std',
+    'Tempo',
+    'Median Beats Per Bar'
+]
+VALUE_NAMES = [
+    'segment_labels',
+    'segment_lengths',
+    'beat_lengths',
+    'beats_per_bar',
+    'segment_start_beat_numbers'
+]
+
+
+class DatasetStatistics(object):
+    """
+    Per-track and corpus-wide statistics of the beat and segment annotations.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._tracks = pd.DataFrame(columns=TRACK_COLUMNS, dtype=np.float64)
+        self._signatures = pd.Series(dtype=object)
+        self._values = {name: (np.array([]), np.array([], dtype=str)) for name in VALUE_NAMES}
+
+    def update(self, annotations):
+        """
+        Brings the statistics up to date with a set of annotations. Only tracks that are new, or whose
+        annotations have changed since the last update, are computed. Tracks that are no longer present
+        are removed.
+
+        Args:
+            annotations: annotation_cache.CompiledAnnotations - The annotations of every track.
+
+        Return:
+            DatasetStatistics - This object, for chaining.
+        """
+        track_ids = annotations.track_ids.astype(str)
+        signatures = pd.Series(_signatures(annotations), index=track_ids)
+        stale = [track_id for track_id in track_ids
+                 if track_id not in self._signatures.index or self._signatures[track_id] != signatures[track_id]]
+        removed = self._tracks.index.difference(track_ids)
+        if not stale and not len(removed):
+            return self
+
+        # Drop outdated tracks
+        keep = self._tracks.index.difference(removed.union(stale))
+        self._tracks = self._tracks.loc[keep]
+        self._signatures = self._signatures.loc[keep]
+        for name, (values, value_tracks) in self._values.items():
+            mask = pd.Index(value_tracks).isin(keep)
+            self._values[name] = (values[mask], value_tracks[mask])
+
+        # Compute stale tracks
+        if stale:
+            tracks, values = _compute(annotations, np.array([annotations.track_index(track_id) for track_id in stale]))
+            self._tracks = pd.concat([self._tracks, tracks]) if len(self._tracks) else tracks
+            self._signatures = pd.concat([self._signatures, signatures[stale]])
+            for name in VALUE_NAMES:
+                old_values, old_tracks = self._values[name]
+                new_values, new_tracks = values[name]
+                self._values[name] = (np.concatenate((old_values, new_values)), np.concatenate((old_tracks, new_tracks)))
+        return self
+
+    @property
+    def track_statistics(self):
+        """
+        Get the statistics of each track.
+
+        Return:
+            pd.DataFrame - Indexed by track ID, the number of segments (excluding the "end" marker), the
+            number of unique labels (including "end"), the standard deviation of the beat length in seconds,
+            the tempo in BPM (taken from the median beat length), and the median number of beats per bar.
+        """
+        return self._tracks
+
+    def label_counts(self):
+        """
+        Get the number of occurrences of each segment label across all tracks.
+
+        Return:
+            pd.Series - The count of each label, most frequent first.
+        """
+        return pd.Series(self._values['segment_labels'][0]).value_counts()
+
+    def segments_per_track_counts(self):
+        """
+        Get the number of tracks with each number of segments.
+
+        Return:
+            pd.Series - The number of tracks, indexed by number of segments.
+        """
+        return self._tracks['Num Segments'].astype(int).value_counts().sort_index()
+
+    def unique_labels_per_track_counts(self):
+        """
+        Get the number of tracks with each number of unique segment labels.
+
+        Return:
+            pd.Series - The number of tracks, indexed by number of unique labels.
+        """
+        return self._tracks['Num Unique Labels'].astype(int).value_counts().sort_index()
+
+    def values(self, name, track_id=None):
+        """
+        Get the values of a statistic with one value per segment, beat or bar, e.g., for plotting histograms.
+
+        Args:
+            name: str - One of `VALUE_NAMES`:
+                "segment_labels" - The label of every segment.
+                "segment_lengths" - The length of every segment in seconds.
+                "beat_lengths" - The length of every beat in seconds.
+                "beats_per_bar" - The number of beats in every bar, excluding the final bar of each track.
+                "segment_start_beat_numbers" - The beat number closest to the start of every segment.
+
+            track_id: str or None - If provided, only the values for this track are returned.
+
+        Return:
+            np.ndarray - The values.
+        """
+        values, value_tracks = self._values[name]
+        if track_id is None:
+            return values
+        return values[value_tracks == track_id]
+
+    def histogram(self, name, bins=10, range=None):
+        """
+        Computes a histogram of a statistic across all tracks.
+
+        Args:
+            name: str - One of `VALUE_NAMES`, or one of `TRACK_COLUMNS`.
+
+            bins: int or np.ndarray - The number of bins, or the bin edges, see `np.histogram`.
+
+            range: tuple(float, float) or None - The range of the bins, see `np.histogram`.
+
+        Return:
+            tuple(np.ndarray, np.ndarray) - The counts and bin edges.
+        """
+        data = self._tracks[name].values if name in TRACK_COLUMNS else self.values(name)
+        return np.histogram(data, bins=bins, range=range)
+
+
+def _signatures(annotations):
+    """
+    Computes a digest of each track's annotations, which changes whenever its beats or segments change.
+    """
+    signatures = []
+    for idx in range(len(annotations.track_ids)):
+        beats = slice(annotations.beat_offsets[idx], annotations.beat_offsets[idx + 1])
+        segments = slice(annotations.segment_offsets[idx], annotations.segment_offsets[idx + 1])
+        digest = hashlib.blake2b(digest_size=16)
+        for values in [annotations.beat_times[beats], annotations.beat_numbers[beats], annotations.bar_numbers[beats],
+                       annotations.segment_times[segments]]:
+            digest.update(np.ascontiguousarray(values).tobytes())
+        digest.update('\n'.join(annotations.label_vocabulary[annotations.segment_labels[segments]]).encode())
+        signatures += [digest.hexdigest()]
+    return signatures
+
+
+def _gather(values, offsets, track_idxs):
+    """
+    Gathers the values of a subset of tracks from a ragged array.
+
+    Return:
+        tuple(np.ndarray, np.ndarray) - The concatenated values of the given tracks, and the position
+        within `track_idxs` of the track that each value belongs to.
+    """
+    starts, ends = offsets[track_idxs], offsets[track_idxs + 1]
+    lengths = ends - starts
+    positions = np.repeat(np.arange(len(track_idxs)), lengths)
+    rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return np.asarray(values)[rows], positions
+
+
+def _within_track_diffs(values, positions):
+    """
+    Computes the differences between consecutive values belonging to the same track.
+
+    Return:
+        tuple(np.ndarray, np.ndarray) - The differences, and the track position of each.
+    """
+    same_track = positions[1:] == positions[:-1]
+    return (values[1:] - values[:-1])[same_track], positions[1:][same_track]
+
+
+def _grouped_median(values, positions, num_groups):
+    """
+    Computes the median of the values in each group, returning NaN for empty groups.
+    """
+    order = np.lexsort((values, positions))
+    values, positions = values[order], positions[order]
+    counts = np.bincount(positions, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    medians = np.full(num_groups, np.nan)
+    nonempty = counts > 0
+    lower = values[(starts + (counts - 1) // 2)[nonempty]]
+    upper = values[(starts + counts // 2)[nonempty]]
+    medians[nonempty] = (lower + upper) / 2.0
+    return medians
+
+
+def _compute(annotations, track_idxs):
+    """
+    Computes the statistics for a subset of tracks, in a single vectorized pass over their annotations.
+
+    Return:
+        tuple(pd.DataFrame, dict(str, tuple(np.ndarray, np.ndarray))) - The per-track statistics, and the
+        values and track ID of each value for every statistic in `VALUE_NAMES`.
+    """
+    num_tracks = len(track_idxs)
+    track_ids = annotations.track_ids[track_idxs].astype(str)
+    vocabulary = annotations.label_vocabulary.astype(str)
+
+    # Segments
+    seg_times, seg_pos = _gather(annotations.segment_times, annotations.segment_offsets, track_idxs)
+    seg_codes, _ = _gather(annotations.segment_labels, annotations.segment_offsets, track_idxs)
+    seg_lengths, seg_length_pos = _within_track_diffs(seg_times, seg_pos)
+    num_segments = np.bincount(seg_pos, minlength=num_tracks) - 1
+    unique_pairs = np.unique(np.stack((seg_pos, seg_codes)), axis=1)
+    num_unique_labels = np.bincount(unique_pairs[0], minlength=num_tracks)
+
+    # Beats
+    beat_times, beat_pos = _gather(annotations.beat_times, annotations.beat_offsets, track_idxs)
+    beat_numbers, _ = _gather(annotations.beat_numbers, annotations.beat_offsets, track_idxs)
+    bar_numbers, _ = _gather(annotations.bar_numbers, annotations.beat_offsets, track_idxs)
+    beat_lengths, beat_length_pos = _within_track_diffs(beat_times, beat_pos)
+    beat_counts = np.bincount(beat_length_pos, minlength=num_tracks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        beat_mean = np.bincount(beat_length_pos, beat_lengths, minlength=num_tracks) / beat_counts
+        deviations = beat_lengths - beat_mean[beat_length_pos]
+        beat_var = np.bincount(beat_length_pos, deviations**2, minlength=num_tracks) / beat_counts
+        tempo = 60.0 / _grouped_median(beat_lengths, beat_length_pos, num_tracks)
+    beat_std = np.sqrt(beat_var)
+
+    # Bars, ignoring the last bar of each track as it is usually incomplete
+    bar_end = (bar_numbers[1:] > bar_numbers[:-1]) & (beat_pos[1:] == beat_pos[:-1])
+    beats_per_bar = beat_numbers[:-1][bar_end]
+    beats_per_bar_pos = beat_pos[:-1][bar_end]
+    median_beats_per_bar = _grouped_median(beats_per_bar.astype(np.float64), beats_per_bar_pos, num_tracks)
+
+    # Beat number closest to each segment start, searching within each track by offsetting every
+    # track's times so that all tracks are sorted one after the other.
+    span = max(np.max(beat_times, initial=0), np.max(seg_times, initial=0)) + 1.0
+    beat_keys = beat_times + beat_pos*span
+    seg_keys = seg_times + seg_pos*span
+    beat_starts = np.searchsorted(beat_pos, np.arange(num_tracks), side='left')
+    beat_ends = np.searchsorted(beat_pos, np.arange(num_tracks), side='right')
+    seg_beat_start, seg_beat_end = beat_starts[seg_pos], beat_ends[seg_pos]
+    has_beats = seg_beat_end > seg_beat_start
+    after = np.clip(np.searchsorted(beat_keys, seg_keys), seg_beat_start, np.maximum(seg_beat_end - 1, seg_beat_start))
+    before = np.maximum(after - 1, seg_beat_start)
+    nearest = np.where(np.abs(beat_keys[np.minimum(before, len(beat_keys) - 1)] - seg_keys)
+                       <= np.abs(beat_keys[np.minimum(after, len(beat_keys) - 1)] - seg_keys), before, after)
+    seg_start_beat_numbers = beat_numbers[nearest[has_beats]] if len(beat_numbers) else np.array([], dtype=np.int64)
+
+    tracks = pd.DataFrame({
+        'Num Segments': num_segments,
+        'Num Unique Labels': num_unique_labels,
+        'Beat Length Std': beat_std,
+        'Tempo': tempo,
+        'Median Beats Per Bar': median_beats_per_bar
+    }, index=track_ids, columns=TRACK_COLUMNS).astype(np.float64)
+    values = {
+        'segment_labels': (vocabulary[seg_codes], track_ids[seg_pos]),
+        'segment_lengths': (seg_lengths, track_ids[seg_length_pos]),
+        'beat_lengths': (beat_lengths, track_ids[beat_length_pos]),
+        'beats_per_bar': (beats_per_bar, track_ids[beats_per_bar_pos]),
+        'segment_start_beat_numbers': (seg_start_beat_numbers, track_ids[seg_pos[has_beats]])
+    }
+    return tracks, values
@@ -0,0 +1,182 @@
+"""
+Created 10-17-26
+
+Decoding of mp3 files ahead of their analysis, so that ffmpeg runs while the analysis workers are busy
+rather than in between.
+
+A bounded number of ffmpeg subprocesses are managed with asyncio in a background thread, and the
+decoded audio is handed to the consumer in the order the files were given. A failure to decode one
+file is returned in place of its audio, without affecting the others.
+"""
+
+
+# Local imports
+from audio_utils import AudioSignal
+from audio_utils import ffmpeg_decode_command
+from audio_utils import mp3_num_channels
+from audio_utils import resample_samples
+from audio_utils import WAV_SAMP_RATE
+
+# Third party imports
+import numpy as np
+
+# Python standard library imports
+import sys
+import asyncio
+import queue
+import threading
+from subprocess import PIPE, DEVNULL
+
+
+DEFAULT_MAX_IN_FLIGHT = 4
+_DONE = object()
+
+
+async def decode_mp3(mp3_fname, dtype=np.int16):
+    """
+    Decodes an mp3 file in an ffmpeg subprocess, without blocking the event loop.
+
+    Args:
+        mp3_fname: str - The filename (with path) of the mp3 file.
+
+        dtype: np.dtype - The sample type, see `audio_utils.mp3_get_samples`.
+
+    Return:
+        np.ndarray - A read-only array of shape (channels, samples) containing the audio sample data.
+    """
+    loop = asyncio.get_running_loop()
+    # NOTE: The file itself, rather than a pipe, is given to ffmpeg as its input, as the write end of an
+    #       input pipe would be inherited by any process forked meanwhile, e.g., by a `multiprocessing.Pool`,
+    #       and ffmpeg would never see the end of its input.
+    with open(mp3_fname, 'rb') as mp3_file:
+        n_channels = await loop.run_in_executor(None, mp3_num_channels, mp3_file)
+        p = await asyncio.create_subprocess_exec(*ffmpeg_decode_command(n_channels, dtype), stdin=mp3_file,
+                                                 stdout=PIPE, stderr=DEVNULL)
+    try:
+        data = await p.stdout.read()
+        await p.wait()
+    except asyncio.CancelledError:
+        p.kill()
+        # NOTE: The process is only reaped once its output has been read to the end, and reading
+        #       may have been paused while the cancelled read was not consuming it.
+        await p.stdout.read()
+        await p.wait()
+        raise
+    if p.returncode != 0:
+        raise Exception('ffmpeg failed to decode mp3 data, exit code: {}'.format(p.returncode))
+    return np.frombuffer(data, dtype=dtype).reshape(-1, n_channels).T
+
+
+def iter_decoded(mp3_fnames, max_in_flight=DEFAULT_MAX_IN_FLIGHT, dtype=np.int16, cache=None, sample_rates=()):
+    """
+    Yields the decoded audio of each of a list of mp3 files, decoding up to `max_in_flight` files
+    ahead of the one being consumed.
+
+    Args:
+        mp3_fnames: list(str) - The filenames (with path) of the mp3 files.
+
+        max_in_flight: int - The maximum number of files being decoded, or decoded and waiting to be
+        consumed, at any one time.
+
+        dtype: np.dtype - The sample type, see `audio_utils.mp3_get_samples`.
+
+        cache: audio_cache.DecodedAudioCache or None - If provided, audio is read from, and decoded into,
+        this cache.
+
+        sample_rates: list(int) - Sample rates, other than the decoder's, that the audio is also resampled
+        to as part of its decoding, see `audio_utils.AudioSignal.resampled`.
+
+    Return:
+        generator(tuple(str, audio_utils.AudioSignal or Exception)) - The filename and decoded audio of
+        each file, in the order given, or the exception raised when decoding it failed.
+    """
+    mp3_fnames = list(mp3_fnames)
+    results = queue.Queue()
+    loop = asyncio.new_event_loop()
+    state = {}
+
+    async def decode_one(fname):
+        try:
+            if cache is not None:
+                samples = await loop.run_in_executor(None, cache.get, fname, dtype)
+            else:
+                samples = await decode_mp3(fname, dtype)
+            resampled = {}
+            for sample_rate in sample_rates:
+                if cache is not None:
+                    resampled[sample_rate] = await loop.run_in_executor(None, cache.get, fname, np.float32,
+                                                                        sample_rate)
+                else:
+                    resampled[sample_rate] = await loop.run_in_executor(None, resample_samples, samples,
+                                                                        WAV_SAMP_RATE, sample_rate)
+            return AudioSignal(samples, filename=fname, resampled=resampled)
+        except Exception as exc:
+            return exc
+
+    async def schedule():
+        slots = state['slots'] = asyncio.Semaphore(max(max_in_flight, 1))
+        ordered = asyncio.Queue()
+        stopping = asyncio.Event()
+
+        async def start():
+            for fname in mp3_fnames:
+                await slots.acquire()
+                ordered.put_nowait((fname, asyncio.ensure_future(decode_one(fname))))
+            ordered.put_nowait(None)
+
+        # Files are started as slots become free, and handed over in order as they finish, in
+        # separate tasks so that neither waits on the other.
+        starter = asyncio.ensure_future(start())
+        in_flight = []
+
+        def stop():
+            stopping.set()
+            starter.cancel()
+            for task in in_flight:
+                task.cancel()
+            ordered.put_nowait(None)
+        state['stop'] = stop
+
+        try:
+            while not stopping.is_set():
+                item = await ordered.get()
+                if item is None or stopping.is_set():
+                    break
+                in_flight[:] = [item[1]]
+                await asyncio.wait([item[1]])
+                if not stopping.is_set():
+                    results.put((item[0], item[1].result()))
+        finally:
+            # Cancel anything still being decoded if the consumer stopped early
+            while not ordered.empty():
+                item = ordered.get_nowait()
+                if item is not None:
+                    in_flight += [item[1]]
+            starter.cancel()
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(starter, *in_flight, return_exceptions=True)
+            results.put(_DONE)
+
+    if sys.version_info < (3, 8) and threading.current_thread() is threading.main_thread():
+        # NOTE: Before Python 3.8, subprocesses can only be awaited in a loop running outside the main
+        #       thread once the child watcher, which handles SIGCHLD in the main thread, is attached to it.
+        asyncio.get_child_watcher().attach_loop(loop)
+
+    scheduler = threading.Thread(target=loop.run_until_complete, args=(schedule(),), daemon=True)
+    scheduler.start()
+    try:
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            # NOTE: The slot is released as the file is handed over, so the consumer's own
+            #       queueing is what bounds how far decoding runs ahead.
+            loop.call_soon_threadsafe(state['slots'].release)
+            yield item
+    finally:
+        if scheduler.is_alive():
+            loop.call_soon_threadsafe(state['stop'])
+        scheduler.join()
+        loop.close()
+
@@ -9,7 +9,12 @@ using the range of algorithms evaluated in the paper.
 # Local imports
 from harmonix_dataset import HarmonixDataset
 from estimator_utils import estimator
-from estimator_utils import process_estimator
+from estimator_utils import process_estimators
+from estimator_utils import configure_audio_cache
+from estimator_utils import cached_processor
+from estimator_utils import configure_activation_store
+from estimator_utils import stored_activations
+from activation_store import madmom_version
 
 # Third party imports
 import librosa
@@ -19,14 +24,26 @@ import madmom
 import argparse
 import os
 import logging
-import tempfile
+from functools import partial
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+ELLIS_SAMP_RATE = 22050
+
+# The madmom beat trackers that post-process the activations of `madmom.features.beats.RNNBeatProcessor`, by the
+# name of their results, see `madmom_1` to `madmom_4`.
+MADMOM_BEAT_TRACKERS = {
+    'Krebs': partial(madmom.features.beats.DBNBeatTrackingProcessor, fps=100),
+    'Korzeniowski': partial(madmom.features.beats.CRFBeatDetectionProcessor, fps=100),
+    'Bock_1': partial(madmom.features.beats.BeatDetectionProcessor, fps=100),
+    'Bock_2': partial(madmom.features.beats.BeatTrackingProcessor, fps=100)
+}
+
+
 @estimator
-def madmom_1(audio_filename):
+def madmom_1(signal):
     """
     Produces beat time estimates according to the paper:
     
@@ -35,18 +52,18 @@ def madmom_1(audio_filename):
         Retrieval Conference (ISMIR), 2015.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
     Return:
         list(float) - The estimates of the beat positions in the audio as a list of positions in seconds.
     """
-    proc = madmom.features.beats.DBNBeatTrackingProcessor(fps=100)
-    act = madmom.features.beats.RNNBeatProcessor()(audio_filename)
-    return proc(act), audio_filename
+    proc = cached_processor(madmom.features.beats.DBNBeatTrackingProcessor, fps=100)
+    act = _beat_activations(signal)
+    return proc(act)
 
 
 @estimator
-def madmom_2(audio_filename):
+def madmom_2(signal):
     """
     Produces beat time estimates according to the paper:
     
@@ -55,18 +72,18 @@ def madmom_2(audio_filename):
         Retrieval Conference (ISMIR), 2014.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
     Return:
         list(float) - The estimates of the beat positions in the audio as a list of positions in seconds.
     """
-    proc = madmom.features.beats.CRFBeatDetectionProcessor(fps=100)
-    act = madmom.features.beats.RNNBeatProcessor()(audio_filename)
-    return proc(act), audio_filename
+    proc = cached_processor(madmom.features.beats.CRFBeatDetectionProcessor, fps=100)
+    act = _beat_activations(signal)
+    return proc(act)
 
 
 @estimator
-def madmom_3(audio_filename):
+def madmom_3(signal):
     """
     Produces beat time estimates according to the paper:
     
@@ -74,18 +91,18 @@ def madmom_3(audio_filename):
         Proceedings of the 14th International Conference on Digital Audio Effects (DAFx), 2011.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
     Return:
         list(float) - The estimates of the beat positions in the audio as a list of positions in seconds.
     """
-    proc = madmom.features.beats.BeatDetectionProcessor(fps=100)
-    act = madmom.features.beats.RNNBeatProcessor()(audio_filename)
-    return proc(act), audio_filename
+    proc = cached_processor(madmom.features.beats.BeatDetectionProcessor, fps=100)
+    act = _beat_activations(signal)
+    return proc(act)
 
 
 @estimator
-def madmom_4(audio_filename):
+def madmom_4(signal):
     """
     Produces beat time estimates according to the paper:
     
@@ -93,18 +110,46 @@ def madmom_4(audio_filename):
         Proceedings of the 14th International Conference on Digital Audio Effects (DAFx), 2011.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
     Return:
         list(float) - The estimates of the beat positions in the audio as a list of positions in seconds.
     """
-    proc = madmom.features.beats.BeatTrackingProcessor(fps=100)
-    act = madmom.features.beats.RNNBeatProcessor()(audio_filename)
-    return proc(act), audio_filename
+    proc = cached_processor(madmom.features.beats.BeatTrackingProcessor, fps=100)
+    act = _beat_activations(signal)
+    return proc(act)
 
 
 @estimator
-def ellis(audio_filename):
+def madmom_all(signal, trackers):
+    """
+    Produces beat time estimates with each of several of the madmom beat trackers, i.e., `madmom_1` to `madmom_4`,
+    computing the beat activations they share only once.
+
+    Args:
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
+
+        trackers: list(str) - The names of the beat trackers to estimate beats with, see `MADMOM_BEAT_TRACKERS`.
+
+    Return:
+        dict(str, list(float)) - The estimates of the beat positions in the audio as a list of positions in seconds,
+        by the name of the beat tracker.
+    """
+    act = _beat_activations(signal)
+    return {name: cached_processor(MADMOM_BEAT_TRACKERS[name])(act) for name in trackers}
+
+
+def _beat_activations(signal):
+    """
+    Get the activations of `madmom.features.beats.RNNBeatProcessor` for the audio, that the madmom beat trackers
+    share, via the activation store if one is configured, see `estimator_utils.stored_activations`.
+    """
+    return stored_activations(signal.filename, 'RNNBeatProcessor', madmom_version(),
+                              lambda: cached_processor(madmom.features.beats.RNNBeatProcessor)(signal.to_madmom()))
+
+
+@estimator(sample_rates=[ELLIS_SAMP_RATE])
+def ellis(signal):
     """
     Produces beat time estimates according to the paper:
     
@@ -113,17 +158,21 @@ def ellis(audio_filename):
     Using the implementation contained in the librosa python module.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
     Return:
         list(float) - The estimates of the beat positions in the audio as a list of positions in seconds.
     """
-    signal, _ = librosa.load(audio_filename)
-    _, result = librosa.beat.beat_track(signal, units='time')
-    return result, audio_filename
+    # NOTE: Equivalent to `librosa.load`, which mixes down to mono and resamples to 22050Hz.
+    samples = librosa.to_mono(signal.resampled(ELLIS_SAMP_RATE))
+    _, result = librosa.beat.beat_track(samples, sr=ELLIS_SAMP_RATE, units='time')
+    return result
 
 
-def main(audio_dir, results_dir):
+
+def main(audio_dir, results_dir, track_ids=None, audio_cache_dir=None, audio_cache_size=50,
+         decode_ahead=0, madmom_trackers=None, resume=False, num_threads=12, start_method='forkserver',
+         activation_dir=None, trace_file=None):
     """
     Estimates beat positions for all files in the Harmonix Set, using the estimators published in the paper.
 
@@ -131,32 +180,64 @@ def main(audio_dir, results_dir):
         audio_dir: str - The complete path to the directory containing mp3 files for all tracks in the Harmonix Set.
 
         results_dir: str - The complete path to the directory to save the estimated beat positions to.
+
+        track_ids: list(str) or None - The IDs of a subset of tracks to analyze, e.g., as returned by
+        `HarmonixDataset.metadata.query`. If None, all tracks are analyzed.
+
+        audio_cache_dir: str or None - A directory in which to cache decoded audio, shared between all
+        estimators and runs. If None, each estimator decodes the audio of each track itself.
+
+        audio_cache_size: float - The maximum size of the decoded audio cache in GB.
+
+        decode_ahead: int - If greater than zero, audio is decoded in the background up to this many tracks
+        ahead of the analysis, see `estimator_utils.process_estimator`.
+
+        madmom_trackers: list(str) or None - The madmom beat trackers to run, see `MADMOM_BEAT_TRACKERS`. If None,
+        all are run.
+
+        resume: bool - If True, tracks whose results have already been saved are skipped, see
+        `estimator_utils.process_estimator`.
+
+        num_threads: int - The number of worker processes shared by the estimators.
+
+        start_method: str - How worker processes are started, either 'forkserver' or 'spawn', see
+        `estimator_utils.process_estimators`.
+
+        activation_dir: str or None - A directory in which to store the activations of the madmom neural networks,
+        e.g., for `sweep_post_processors.py`. If None, activations are not stored.
+
+        trace_file: str or None - A file to write the time spent in each stage of the analysis of each track to,
+        as JSON lines, see `estimator_utils.process_estimators`. A summary is logged either way.
     """
+    configure_audio_cache(audio_cache_dir, int(audio_cache_size*1024**3))
+    configure_activation_store(activation_dir)
+
     #
     # Get the filenames from the dataset, these should correspond to the filenames of the audio files.
     #
-    dataset = HarmonixDataset()
+    dataset = HarmonixDataset(use_cache=True)
     filenames_and_beats = dataset.beat_time_lists
+    if track_ids is not None:
+        filenames_and_beats = {track_id: filenames_and_beats[track_id] for track_id in track_ids}
     filenames = [os.path.join(audio_dir, os.path.splitext(os.path.basename(fname))[0] + '.mp3') for fname in filenames_and_beats.keys()]
+    durations = dict(zip(filenames, dataset.metadata.values('Duration', list(filenames_and_beats.keys()))))
 
     #
     # Compile arguments and run estimators
     #
-    # NOTE [matt.c.mccallum 10.13.19]: Librosa is done on a single thread due to a locking issue
-    #                                  when using the `librosa.load` function and the multiprocessing module.
-    #                                  This causes the `librosa.load` function to hang indefinitely.
-    #                                  This may be due to the specific decoder that Librosa uses and so this
-    #                                  may be platform dependent as is the decoder selection.
+    # The madmom beat trackers are run together, as they differ only in how they post-process the same activations.
+    # The tasks of all estimators share a single pool of workers, longest track first.
+    if madmom_trackers is None:
+        madmom_trackers = list(MADMOM_BEAT_TRACKERS)
     args = [(fname,) for fname in filenames]
+    madmom_args = [(fname, madmom_trackers) for fname in filenames]
+    madmom_dirs = {name: os.path.join(results_dir, name) for name in madmom_trackers}
     estimator_args = [
-        (args, madmom_1, os.path.join(results_dir, 'Krebs'), 12),
-        (args, madmom_2, os.path.join(results_dir, 'Korzeniowski'), 12),
-        (args, madmom_3, os.path.join(results_dir, 'Bock_1'), 12),
-        (args, madmom_4, os.path.join(results_dir, 'Bock_2'), 12),
-        (args, ellis, os.path.join(results_dir, 'Ellis'), 1)
+        (madmom_args, madmom_all, madmom_dirs),
+        (args, ellis, os.path.join(results_dir, 'Ellis'))
     ]
-    for args in estimator_args:
-        process_estimator(*args)
+    process_estimators(estimator_args, num_threads, decode_ahead=decode_ahead, resume=resume, durations=durations,
+                       start_method=start_method, trace_file=trace_file)
 
 
 if __name__=='__main__':
@@ -164,5 +245,14 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Estimates beat positions for mp3 audio of tracks in the harmonix dataset')
     parser.add_argument('--audio-dir', default=os.path.join(THIS_PATH, '../dataset/audio'), type=str)
     parser.add_argument('--results-dir', default=os.path.join(THIS_PATH, '../results/beats'), type=str)
+    parser.add_argument('--audio-cache-dir', default=None, type=str)
+    parser.add_argument('--audio-cache-size', default=50, type=float)
+    parser.add_argument('--decode-ahead', default=0, type=int)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--num-threads', default=12, type=int)
+    parser.add_argument('--start-method', default='forkserver', choices=['forkserver', 'spawn'])
+    parser.add_argument('--activation-dir', default=None, type=str)
+    parser.add_argument('--trace-file', default=None, type=str)
+    parser.add_argument('--madmom-trackers', default=None, nargs='+', choices=list(MADMOM_BEAT_TRACKERS))
     kwargs = vars(parser.parse_args())
     main(**kwargs)
@@ -7,6 +7,11 @@ Created 10-13-19 by Matt C. McCallum
 from harmonix_dataset import HarmonixDataset
 from estimator_utils import estimator
 from estimator_utils import process_estimator
+from estimator_utils import configure_audio_cache
+from estimator_utils import cached_processor
+from estimator_utils import configure_activation_store
+from estimator_utils import stored_activations
+from activation_store import madmom_version
 
 # Third party imports
 import madmom
@@ -21,8 +26,12 @@ import logging
 logging.basicConfig(level=logging.INFO)
 
 
+# The madmom downbeat trackers, by the name of their results, see `madmom_1` and `madmom_2`.
+MADMOM_DOWNBEAT_TRACKERS = ['Bock_1', 'Bock_2']
+
+
 @estimator
-def madmom_1(filename, reference_beats_filename):
+def madmom_1(signal, reference_beats):
     """
     Estimates beats using reference beats and the `DBNBarTrackingProcessor` provided
     with madmom:
@@ -34,26 +43,20 @@ def madmom_1(filename, reference_beats_filename):
     This estimator uses reference beat positions to estimate downbeat positions.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
-        reference_beats_filename: str - The filename (with path) to a csv file containing the beat positions
-        as the first column.
+        reference_beats: list(float) or str - The beat positions in seconds, e.g., from
+        `HarmonixDataset.beat_time_lists` or a beat estimator, or the filename (with path) to a csv file
+        containing the beat positions as the first column.
 
     Return:
         list(float) - The estimates of the downbeat positions in the audio as a list of positions in seconds.
     """
-    proc = madmom.features.downbeats.DBNBarTrackingProcessor(beats_per_bar=[3, 4])
-    beats = np.loadtxt(reference_beats_filename)[:,0]
-    act = madmom.features.downbeats.RNNBarProcessor()((filename, beats))
-    downbeat_data = proc(act)
-    estimated_beats = downbeat_data[:, 0]
-    estimated_downbeats = downbeat_data[:, 1]
-    downbeat_inds = np.argwhere((estimated_downbeats[1:]-estimated_downbeats[:-1]) < 0)
-    return estimated_beats[downbeat_inds].flatten(), filename
+    return _bar_tracker_downbeats(signal.filename, signal.to_madmom(), reference_beats)
 
 
 @estimator
-def madmom_2(filename, reference_beats_filename):
+def madmom_2(signal, reference_beats_filename):
     """
     Produces downbeat time estimates according to the algorithm described in:
 
@@ -62,24 +65,84 @@ def madmom_2(filename, reference_beats_filename):
         (ISMIR), 2016.
 
     Args:
-        filname: str - The filename (with path) to the mp3 audio file to be analyzed by this algorithm.
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
 
-        reference_beats_filename: str - Not used, only provided here for consistence of interface with other
+        reference_beats: list(float) or str - Not used, only provided here for consistence of interface with other
         downbeat estimator functions.
 
     Return:
         list(float) - The estimates of the downbeat positions in the audio as a list of positions in seconds.
     """
-    proc = madmom.features.downbeats.DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], fps=100)
-    act = madmom.features.downbeats.RNNDownBeatProcessor()(filename)
-    downbeat_data = proc(act)
+    return _joint_tracker_downbeats(signal.filename, signal.to_madmom())
+
+
+@estimator
+def madmom_all(signal, reference_beats, trackers):
+    """
+    Produces downbeat time estimates with each of several of the madmom downbeat trackers, i.e., `madmom_1` and
+    `madmom_2`, from a single decode of the audio and a single conversion of it to a madmom signal, that both
+    of their activations are computed from.
+
+    Args:
+        signal: audio_utils.AudioSignal - The decoded audio to be analyzed by this algorithm.
+
+        reference_beats: list(float) or str - The beat positions used by `madmom_1`, see `madmom_1`.
+
+        trackers: list(str) - The names of the downbeat trackers to estimate downbeats with, see
+        `MADMOM_DOWNBEAT_TRACKERS`.
+
+    Return:
+        dict(str, list(float)) - The estimates of the downbeat positions in the audio as a list of positions in
+        seconds, by the name of the downbeat tracker.
+    """
+    madmom_signal = signal.to_madmom()
+    estimates = {}
+    if 'Bock_1' in trackers:
+        estimates['Bock_1'] = _bar_tracker_downbeats(signal.filename, madmom_signal, reference_beats)
+    if 'Bock_2' in trackers:
+        estimates['Bock_2'] = _joint_tracker_downbeats(signal.filename, madmom_signal)
+    return estimates
+
+
+def _bar_tracker_downbeats(fname, madmom_signal, reference_beats):
+    """
+    Estimates downbeats with `RNNBarProcessor` activations at the given beats, see `madmom_1`. The activations
+    are stored by a version that includes the beats, see `estimator_utils.stored_activations`.
+    """
+    if isinstance(reference_beats, str):
+        reference_beats = np.loadtxt(reference_beats)[:,0]
+    reference_beats = np.asarray(reference_beats, dtype=float)
+    proc = cached_processor(madmom.features.downbeats.DBNBarTrackingProcessor, beats_per_bar=[3, 4])
+    act = stored_activations(fname, 'RNNBarProcessor', madmom_version(reference_beats),
+                             lambda: cached_processor(madmom.features.downbeats.RNNBarProcessor)((madmom_signal, reference_beats)))
+    return downbeat_times(proc(act))
+
+
+def _joint_tracker_downbeats(fname, madmom_signal):
+    """
+    Estimates downbeats with `RNNDownBeatProcessor` activations, see `madmom_2`, via the activation store if one is
+    configured.
+    """
+    proc = cached_processor(madmom.features.downbeats.DBNDownBeatTrackingProcessor, beats_per_bar=[3, 4], fps=100)
+    act = stored_activations(fname, 'RNNDownBeatProcessor', madmom_version(),
+                             lambda: cached_processor(madmom.features.downbeats.RNNDownBeatProcessor)(madmom_signal))
+    return downbeat_times(proc(act))
+
+
+def downbeat_times(downbeat_data):
+    """
+    Get the positions in seconds of the downbeats in the output of a madmom downbeat tracker, i.e., an array
+    of beat positions and their numbers within the bar.
+    """
     estimated_beats = downbeat_data[:, 0]
     estimated_downbeats = downbeat_data[:, 1]
     downbeat_inds = np.argwhere((estimated_downbeats[1:]-estimated_downbeats[:-1]) < 0)
-    return estimated_beats[downbeat_inds].flatten(), filename
+    return estimated_beats[downbeat_inds].flatten()
 
 
-def main(audio_dir, results_dir, beats_dir):
+
+def main(audio_dir, results_dir, beats_dir=None, track_ids=None, audio_cache_dir=None, audio_cache_size=50,
+         decode_ahead=0, madmom_trackers=None, resume=False, num_threads=12, activation_dir=None, trace_file=None):
     """
     Estimates beat positions for all files in the Harmonix Set, using the estimators published in the paper.
 
@@ -88,30 +151,65 @@ def main(audio_dir, results_dir, beats_dir):
 
         results_dir: str - The complete path to the directory to save the estimated beat positions to.
 
-        beats_dir: str - The complete path to a directory containing reference beat markers for each track. The
-        beat markers are to be stored in an individual file for each track, with the first column of that csv file
-        pertaining to the beat marker values in seconds.
+        beats_dir: str or None - The complete path to a directory containing reference beat markers for each track,
+        e.g., as estimated by `estimate_beats`. The beat markers are to be stored in an individual file for each
+        track, with the first column of that csv file pertaining to the beat marker values in seconds. If None, the
+        beats annotated in the dataset are used, as already loaded in memory.
+
+        track_ids: list(str) or None - The IDs of a subset of tracks to analyze, e.g., as returned by
+        `HarmonixDataset.metadata.query`. If None, all tracks are analyzed.
+
+        audio_cache_dir: str or None - A directory in which to cache decoded audio, shared between all
+        estimators and runs. If None, each estimator decodes the audio of each track itself.
+
+        audio_cache_size: float - The maximum size of the decoded audio cache in GB.
+
+        decode_ahead: int - If greater than zero, audio is decoded in the background up to this many tracks
+        ahead of the analysis, see `estimator_utils.process_estimator`.
+
+        madmom_trackers: list(str) or None - The madmom downbeat trackers to run, see `MADMOM_DOWNBEAT_TRACKERS`.
+        If None, all are run.
+
+        resume: bool - If True, tracks whose results have already been saved are skipped, see
+        `estimator_utils.process_estimator`.
+
+        num_threads: int - The number of worker processes shared by the estimators.
+
+        activation_dir: str or None - A directory in which to store the activations of the madmom neural networks,
+        e.g., for `sweep_post_processors.py`. If None, activations are not stored.
+
+        trace_file: str or None - A file to write the time spent in each stage of the analysis of each track to,
+        as JSON lines, see `estimator_utils.process_estimators`. A summary is logged either way.
     """
+    configure_audio_cache(audio_cache_dir, int(audio_cache_size*1024**3))
+    configure_activation_store(activation_dir)
+
     #
     # Get the filenames from the dataset, these should correspond to the filenames of the audio files.
     #
-    dataset = HarmonixDataset()
+    dataset = HarmonixDataset(use_cache=True)
     filenames_and_beats = dataset.beat_time_lists
+    if track_ids is not None:
+        filenames_and_beats = {track_id: filenames_and_beats[track_id] for track_id in track_ids}
     filenames = [os.path.join(audio_dir, os.path.splitext(os.path.basename(fname))[0] + '.mp3') for fname in filenames_and_beats.keys()]
-    beat_fnames = [os.path.join(beats_dir, os.path.splitext(os.path.basename(fname))[0] + '.txt') for fname in filenames]
+    durations = dict(zip(filenames, dataset.metadata.values('Duration', list(filenames_and_beats.keys()))))
+    if beats_dir is not None:
+        beats = [os.path.join(beats_dir, os.path.splitext(os.path.basename(fname))[0] + '.txt') for fname in filenames]
+    else:
+        beats = list(filenames_and_beats.values())
 
     #
     # Compile arguments and run estimators
     #
     # NOTE [matt.c.mccallum 10.13.19]: Unfortunately the Durand algorithm provided in the published results is not
-    # available as it is not open source. Only madmom algorithms are included below.
-    args = list(zip(filenames, beat_fnames))
-    estimator_args = [
-        (args, madmom_1, os.path.join(results_dir, 'Bock_1'), 12),
-        (args, madmom_2, os.path.join(results_dir, 'Bock_2'), 12)
-    ]
-    for args in estimator_args:
-        process_estimator(*args)
+    # available as it is not open source. Only madmom algorithms are included below, and are run together on
+    # each track.
+    if madmom_trackers is None:
+        madmom_trackers = list(MADMOM_DOWNBEAT_TRACKERS)
+    args = [(fname, track_beats, madmom_trackers) for fname, track_beats in zip(filenames, beats)]
+    madmom_dirs = {name: os.path.join(results_dir, name) for name in madmom_trackers}
+    process_estimator(args, madmom_all, madmom_dirs, num_threads, decode_ahead=decode_ahead, resume=resume,
+                      durations=durations, trace_file=trace_file)
 
 
 if __name__=='__main__':
@@ -119,6 +217,14 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Estimates beat positions for mp3 audio of tracks in the harmonix dataset')
     parser.add_argument('--audio-dir', default=os.path.join(THIS_PATH, '../dataset/audio'), type=str)
     parser.add_argument('--results-dir', default=os.path.join(THIS_PATH, '../results/downbeats'), type=str)
-    parser.add_argument('--beats-dir', default=os.path.join(THIS_PATH, '../dataset/beats_and_downbeats'), type=str)
+    parser.add_argument('--beats-dir', default=None, type=str)
+    parser.add_argument('--audio-cache-dir', default=None, type=str)
+    parser.add_argument('--audio-cache-size', default=50, type=float)
+    parser.add_argument('--decode-ahead', default=0, type=int)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--num-threads', default=12, type=int)
+    parser.add_argument('--activation-dir', default=None, type=str)
+    parser.add_argument('--trace-file', default=None, type=str)
+    parser.add_argument('--madmom-trackers', default=None, nargs='+', choices=MADMOM_DOWNBEAT_TRACKERS)
     kwargs = vars(parser.parse_args())
     main(**kwargs)
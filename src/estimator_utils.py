@@ -4,52 +4,218 @@ Created 10-13-19 by Matt C. McCallum
 
 
 # Local imports
-from audio_utils import mp3_to_wav
+from audio_utils import mp3_get_samples
+from audio_utils import AudioSignal
+from audio_utils import resample_samples
+from audio_utils import WAV_SAMP_RATE
+from audio_cache import DecodedAudioCache
+from audio_cache import DEFAULT_MAX_BYTES
+from activation_store import ActivationStore
+from pipeline_trace import PipelineTrace
+from pipeline_trace import stage
+from pipeline_trace import traced_task
+from decode_pipeline import iter_decoded
+from worker_pool import WorkerPool
+from worker_pool import DEFAULT_MAX_RSS
+from worker_pool import peak_rss
 
 # Third party imports
-# None.
+from mutagen import mp3
+import numpy as np
 
 # Python standard library imports
-from multiprocessing import Pool
 import os
-import tempfile
+import time
+import itertools
 import traceback
 from functools import wraps
 import logging
 
 
-def estimator(func):
+# The decoded audio cache used by all estimators in this process, if any, see `configure_audio_cache`.
+_AUDIO_CACHE = None
+
+# The activation store used by all estimators in this process, if any, see `configure_activation_store`.
+_ACTIVATION_STORE = None
+
+# The processors constructed in this process, see `cached_processor`.
+_PROCESSORS = {}
+
+
+def configure_audio_cache(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Sets a decoded audio cache to be shared by every estimator, such that each track is decoded once
+    across all estimators and runs. Worker processes started after this call inherit the cache.
+
+    Args:
+        cache_dir: str or None - The directory in which to store decoded audio. If None, caching
+        is disabled and every estimator decodes its own audio.
+
+        max_bytes: int - The maximum total size of the cached audio in bytes.
+    """
+    global _AUDIO_CACHE
+    _AUDIO_CACHE = DecodedAudioCache(cache_dir, max_bytes) if cache_dir is not None else None
+
+
+def configure_activation_store(store_dir):
+    """
+    Sets an activation store to be shared by every estimator, such that the activations of their neural
+    networks are saved for later runs, e.g., parameter sweeps of their post-processors, see
+    `stored_activations`. Worker processes started after this call use the store too.
+
+    Args:
+        store_dir: str or None - The directory in which to store activations. If None, activations are
+        not stored.
+    """
+    global _ACTIVATION_STORE
+    _ACTIVATION_STORE = ActivationStore(store_dir) if store_dir is not None else None
+
+
+def stored_activations(fname, processor, version, func, *args):
+    """
+    Get the activations of a neural network processor for an audio file, from the activation store if one
+    is configured and already holds them, or else computing them, and storing them if a store is configured.
+
+    Args:
+        fname: str - The filename (with path) of the mp3 file, named after the ID of its track.
+
+        processor: str - The name of the processor, e.g., "RNNBeatProcessor".
+
+        version: str - The version of the processor's models, see `activation_store.madmom_version`.
+
+        func: function - A function that computes the activations.
+
+        args: list(*) - The arguments of `func`.
+
+    Return:
+        np.ndarray - The activations.
+    """
+    with stage('activation'):
+        if _ACTIVATION_STORE is None:
+            return func(*args)
+        track_id = os.path.splitext(os.path.basename(fname))[0]
+        return _ACTIVATION_STORE.compute(track_id, processor, version, func, *args)
+
+
+def estimator(func=None, needs_path=False, sample_rates=()):
     """
     Simple wrapper function around a function that analyizes a file. 
     The wrapper logs the function that is analyzing the file and the
     file that is being analyzed.
 
+    The wrapper decodes the audio file and passes the decoded audio to the function in memory.
+    Functions that can only read audio from a file may set `needs_path`, e.g.,
+    `@estimator(needs_path=True)`, to receive the filename of a temporary wav file instead.
+    Functions that analyze audio at other sample rates may list them in `sample_rates`, such that the
+    audio is resampled to them as it is decoded, see `audio_utils.AudioSignal.resampled`.
+
+    The time spent in the function, other than in the stages timed within it, e.g., its activations, is
+    timed as its "post_processing" stage, see `pipeline_trace.stage`.
+
     Args:
-        func: function - A file analysis function that takes the filename as the first
-        argument.
+        func: function - A file analysis function that takes an `audio_utils.AudioSignal` as the
+        first argument, and returns its estimates.
+
+        needs_path: bool - If True, the function takes the filename of a wav file as the first
+        argument instead.
+
+        sample_rates: list(int) - The sample rates, other than the decoder's, the function analyzes
+        the audio at.
 
     Return:
-        function - The wrapped function (with logging).
+        function - The wrapped function (with logging), which takes the mp3 filename, or audio already
+        decoded from it as an `audio_utils.AudioSignal`, as the first argument.
     """
+    if func is None:
+        return lambda func: estimator(func, needs_path=needs_path, sample_rates=sample_rates)
+
     @wraps(func)
     def est_func(fname, *args, **kwargs):
+        signal = None
+        if isinstance(fname, AudioSignal):
+            signal, fname = fname, fname.filename
         logging.info('Analyzing  "{}" estimator for track: {}'.format(func.__name__, fname))
         try:
-            with tempfile.NamedTemporaryFile(mode='wb', suffix='.wav', prefix='tmp') as temp_audio_file:
-                with open(fname, 'rb') as mp3_file:
-                    temp_audio_file.write(mp3_to_wav(mp3_file).read())
-                result = func(temp_audio_file.name, *args, **kwargs)
-            return result[0], fname
+            if signal is None:
+                signal = load_signal(fname, sample_rates)
+            if needs_path:
+                with signal.as_wav_file() as wav_fname, stage('post_processing'):
+                    result = func(wav_fname, *args, **kwargs)
+            else:
+                with stage('post_processing'):
+                    result = func(signal, *args, **kwargs)
+            return result, fname
         except Exception:
             logging.error('Failed to analyze "{}" for track: {}'.format(func.__name__, fname), exc_info=True)
             return [[], fname]
+    est_func.sample_rates = tuple(sample_rates)
     return est_func
 
 
-def process_estimator(args, estimator, output_dir, num_threads):
+def cached_processor(processor_class, *args, **kwargs):
+    """
+    Get a processor, e.g., a madmom neural network, that is constructed only once in each process and reused
+    by every track analyzed there, as the workers of `process_estimator` each analyze many tracks.
+
+    Args:
+        processor_class: type - The class of the processor, or any function that constructs it.
+
+        args: list(*) - The positional arguments of the processor's constructor.
+
+        kwargs: dict(str, *) - The keyword arguments of the processor's constructor.
+
+    Return:
+        * - The processor constructed with the given arguments.
+    """
+    key = (processor_class, repr(args), repr(sorted(kwargs.items())))
+    if key not in _PROCESSORS:
+        _PROCESSORS[key] = processor_class(*args, **kwargs)
+    return _PROCESSORS[key]
+
+
+def load_signal(fname, sample_rates=()):
+    """
+    Decodes an mp3 file, and resamples it to each of the given sample rates, via the decoded audio
+    cache if one is configured.
+
+    Args:
+        fname: str - The filename (with path) of the mp3 file.
+
+        sample_rates: list(int) - Sample rates, other than the decoder's, to resample the audio to.
+
+    Return:
+        audio_utils.AudioSignal - The decoded audio.
+    """
+    samples = load_samples(fname)
+    if _AUDIO_CACHE is not None:
+        resampled = {sample_rate: _AUDIO_CACHE.get(fname, np.float32, sample_rate) for sample_rate in sample_rates}
+    else:
+        resampled = {sample_rate: resample_samples(samples, WAV_SAMP_RATE, sample_rate) for sample_rate in sample_rates}
+    return AudioSignal(samples, filename=fname, resampled=resampled)
+
+
+def load_samples(fname):
+    """
+    Decodes an mp3 file to int16 samples, via the decoded audio cache if one is configured.
+
+    Args:
+        fname: str - The filename (with path) of the mp3 file.
+
+    Return:
+        np.ndarray - A read-only array of shape (channels, samples) containing the audio sample data.
+    """
+    if _AUDIO_CACHE is not None:
+        return _AUDIO_CACHE.get(fname, np.int16)
+    with open(fname, 'rb') as mp3_file:
+        return mp3_get_samples(mp3_file, dtype=np.int16)
+
+
+def process_estimator(args, estimator, output_dir, num_threads, decode_ahead=0, max_worker_rss=DEFAULT_MAX_RSS,
+                      resume=False, durations=None, start_method='forkserver', trace_file=None):
     """
     Process all files provided by a given algorithm and places the results
-    as new-line separated values in a text file.
+    as new-line separated values in a text file. The results for each file are saved as
+    soon as its analysis completes, such that an interrupted run may be resumed.
 
     Args:
         args: list(tuple(str, *)) - A list of sets of arguments to pass to the estimator function,
@@ -59,26 +225,223 @@ def process_estimator(args, estimator, output_dir, num_threads):
         estimator: function - A function that takes in an audio filename and produces
         estimates of beat positions as list of float values (in seconds).
 
-        output_dir: str - The path to a directory within which to save the beat position
-        estimates as individual text files - one per file specified in `filenames`.
+        output_dir: str or dict(str, str) - The path to a directory within which to save the beat position
+        estimates as individual text files - one per file specified in `filenames`. Estimators that produce
+        several sets of estimates at once return them as a dict, and are given a dict with the same keys,
+        of the directory for each set of estimates.
 
         num_threads: int - The number of threads to use to analyze the set of files.
         each file for analysis is assigned to a single one of these threads, while the
-        files themselves are split between threads.
-    """
-    # Analyze beats
-    if num_threads > 1:
-        the_pool = Pool(num_threads, maxtasksperchild=1)
-        estimates = the_pool.starmap(estimator, args)
-        the_pool.close()
-        the_pool.join()
-    else:
-        estimates = [estimator(*arg) for arg in args]
+        files themselves are split between threads. The worker processes persist between
+        files, see `cached_processor`.
+
+        decode_ahead: int - If greater than zero, audio is decoded in the background up to this many
+        files ahead of the analysis, rather than by each analysis task before it starts.
+
+        max_worker_rss: int or None - The resident memory in bytes above which a worker process is
+        replaced after analyzing a file, see `worker_pool.WorkerPool`.
+
+        resume: bool - If True, files whose results have all been saved since the file was last
+        modified are skipped.
+
+        durations: dict(str, float) or None - The duration in seconds of each file, used to analyze the
+        longest files first, see `process_estimators`.
+
+        start_method: str - How worker processes are started, see `process_estimators`.
+
+        trace_file: str or None - The filename (with path) of a file to write the time spent in each stage
+        of the analysis of each file to, see `process_estimators`.
+    """
+    process_estimators([(args, estimator, output_dir)], num_threads, decode_ahead, max_worker_rss, resume,
+                       durations, start_method, trace_file)
+
+
+def process_estimators(jobs, num_threads, decode_ahead=0, max_worker_rss=DEFAULT_MAX_RSS, resume=False,
+                       durations=None, start_method='forkserver', trace_file=None):
+    """
+    Process all files with each of several estimators, as `process_estimator` does for one, sharing a
+    single pool of workers between every (file, estimator) task.
+
+    Tasks are started in order of the duration of their file, longest first, such that the workers are
+    not left idle at the end of the run while a long file is still being analyzed. When the audio is
+    decoded ahead, it is decoded once for all of the tasks of each file.
+
+    The time spent in each stage of each task, see `pipeline_trace.STAGES`, and the peak memory of the
+    worker that ran it, are recorded, and summarized by estimator and by stage at the end of the run.
+
+    Args:
+        jobs: list(tuple(list(tuple(str, *)), function, str or dict(str, str))) - The arguments, estimator
+        and output directory of each estimator to run, see `process_estimator`.
+
+        num_threads: int - The number of worker processes shared by all estimators.
+
+        decode_ahead: int - If greater than zero, audio is decoded in the background up to this many
+        files ahead of the analysis, see `process_estimator`.
+
+        max_worker_rss: int or None - The resident memory in bytes above which a worker process is
+        replaced, see `process_estimator`.
+
+        resume: bool - If True, tasks whose results have already been saved are skipped, see
+        `process_estimator`.
+
+        durations: dict(str, float) or None - The duration in seconds of each file, by filename, e.g.,
+        from the `Duration` column of the dataset metadata. The durations of files that are not included
+        are read from their mp3 headers.
+
+        start_method: str - How worker processes are started, either 'forkserver' or 'spawn'. Workers are
+        never forked directly from this process, which may be running decoder threads and subprocesses, as
+        librosa-based estimators, e.g., `estimate_beats.ellis`, were found to hang in forked workers.
+
+        trace_file: str or None - The filename (with path) of a file to write a JSON line to for each task,
+        with the time spent in each of its stages, followed by the summary of the run. If None, the summary
+        is only logged.
+    """
+    if start_method not in ('forkserver', 'spawn'):
+        raise Exception('Unsupported worker start method: {}'.format(start_method))
+    output_dirs = [output_dir if isinstance(output_dir, dict) else {None: output_dir} for _, _, output_dir in jobs]
+    tasks = []
+    for job_index, (args, estimator, _) in enumerate(jobs):
+        job_tasks = [(arg[0], job_index, arg) for arg in args
+                     if not (resume and _is_saved(arg[0], output_dirs[job_index]))]
+        if resume:
+            logging.info('Skipping {} of {} files already analyzed by estimator: "{}"'.format(
+                len(args) - len(job_tasks), len(args), estimator.__name__))
+        tasks += job_tasks
+
+    trace = PipelineTrace(trace_file)
+
+    # Order the tasks longest file first, keeping the tasks of each file together
+    durations = dict(durations or {})
+    first_index = {}
+    with traced_task() as stages:
+        for fname, _, _ in tasks:
+            if fname not in durations:
+                durations[fname] = _mp3_duration(fname)
+            first_index.setdefault(fname, len(first_index))
+    trace.add_stages(stages, sum(durations[fname] for fname in first_index))
+    tasks.sort(key=lambda task: (-durations[task[0]], first_index[task[0]]))
+
+    def save(job_index, est, record=None):
+        start = time.perf_counter()
+        _save_estimates(est, output_dirs[job_index])
+        if record is not None:
+            record['stages']['result_write'] = time.perf_counter() - start
+            record['seconds'] += record['stages']['result_write']
+            trace.add_task(jobs[job_index][1].__name__, est[1], durations[est[1]], **record)
+
+    # Analyze beats, saving the results for each file as it completes
+    with trace:
+        if decode_ahead > 0:
+            # Files that fail to decode are saved as such without being analyzed
+            task_args = _decoded_tasks(tasks, jobs, decode_ahead, save, trace, durations)
+        else:
+            task_args = ((jobs[job_index][1], job_index) + tuple(arg) for _, job_index, arg in tasks)
+        if num_threads > 1:
+            with WorkerPool(num_threads, max_worker_rss, start_method, _init_worker,
+                            (_AUDIO_CACHE, _ACTIVATION_STORE)) as the_pool:
+                for job_index, est, record in the_pool.imap_unordered(_run_task, task_args):
+                    save(job_index, est, record)
+                if the_pool.num_recycled:
+                    logging.info('Replaced {} worker processes over the memory limit'.format(the_pool.num_recycled))
+        else:
+            for task_arg in task_args:
+                save(*_run_task(*task_arg))
+
+    logging.info('Saved results for estimators: {}'.format(', '.join('"{}"'.format(job[1].__name__) for job in jobs)))
 
-    logging.info('Saving results for estimator: "{}"'.format(estimator.__name__))
 
-    # Save beats
-    for est in estimates:
-        output_fname = os.path.join(output_dir,  os.path.splitext(os.path.basename(est[1]))[0] + '.txt')
-        with open(output_fname, 'w') as f:
-            f.write('\n'.join([str(time_marker) for time_marker in est[0]]))
+def _output_fname(fname, key_dir):
+    """
+    Get the filename of the results for an audio file, in a given output directory.
+    """
+    return os.path.join(key_dir,  os.path.splitext(os.path.basename(fname))[0] + '.txt')
+
+
+def _is_saved(fname, output_dirs):
+    """
+    Get whether the results for an audio file have been saved in every output directory since the file
+    was last modified, see `process_estimator`.
+    """
+    mtime = os.path.getmtime(fname)
+    for key_dir in output_dirs.values():
+        output_fname = _output_fname(fname, key_dir)
+        if not os.path.exists(output_fname) or os.path.getmtime(output_fname) < mtime:
+            return False
+    return True
+
+
+def _save_estimates(est, output_dirs):
+    """
+    Saves the estimates for an audio file, as returned by an estimator, see `process_estimator`.
+    """
+    for key, key_dir in output_dirs.items():
+        # NOTE: A failed analysis returns an empty list, in place of a dict, that is saved to every directory.
+        time_markers = est[0].get(key, []) if isinstance(est[0], dict) else est[0]
+        output_fname = _output_fname(est[1], key_dir)
+        # NOTE: Results are written under a temporary name and then renamed, such that a run that is
+        #       interrupted never leaves a partial results file to be skipped when resuming.
+        with open(output_fname + '.tmp', 'w') as f:
+            f.write('\n'.join([str(time_marker) for time_marker in time_markers]))
+        os.replace(output_fname + '.tmp', output_fname)
+
+
+def _init_worker(audio_cache, activation_store):
+    """
+    Sets up a worker process of `process_estimators`, that does not inherit the configuration of this one.
+    """
+    global _AUDIO_CACHE, _ACTIVATION_STORE
+    _AUDIO_CACHE = audio_cache
+    _ACTIVATION_STORE = activation_store
+
+
+def _run_task(estimator, job_index, *args):
+    """
+    Runs a single task of `process_estimators`.
+
+    Return:
+        tuple(int, tuple(*, str), dict(str, *)) - The index of the task's job, the estimates and filename
+        returned by the estimator, and the record of the task, see `pipeline_trace.PipelineTrace.add_task`.
+    """
+    start = time.perf_counter()
+    with traced_task() as stages:
+        est = estimator(*args)
+    return job_index, est, {'seconds': time.perf_counter() - start, 'stages': stages, 'pid': os.getpid(),
+                            'peak_rss': peak_rss()}
+
+
+def _mp3_duration(fname):
+    """
+    Get the duration of an mp3 file in seconds from its header, or zero if it cannot be read.
+    """
+    try:
+        with stage('mp3_header'):
+            return mp3.MP3(fname).info.length
+    except Exception:
+        return 0.0
+
+
+def _decoded_tasks(tasks, jobs, decode_ahead, save, trace, durations):
+    """
+    Get the arguments of each analysis task with its audio decoded ahead of time, see `process_estimators`.
+    Each file is decoded once for all of its consecutive tasks. Files that fail to decode are logged and
+    skipped, and their empty estimates passed to `save`. The time spent waiting for each file to be decoded
+    is added to `trace`.
+
+    Return:
+        generator(tuple(function, int, audio_utils.AudioSignal, *)) - The arguments of `_run_task` for each
+        task, in the order given.
+    """
+    groups = [(fname, list(group)) for fname, group in itertools.groupby(tasks, key=lambda task: task[0])]
+    sample_rates = sorted(set(sample_rate for job in jobs for sample_rate in getattr(job[1], 'sample_rates', ())))
+    decoded = iter_decoded([fname for fname, _ in groups], decode_ahead, np.int16, _AUDIO_CACHE, sample_rates)
+    for fname, group in groups:
+        with traced_task() as stages, stage('decode_wait'):
+            _, signal = next(decoded)
+        trace.add_stages(stages, durations[fname])
+        if isinstance(signal, Exception):
+            logging.error('Failed to decode track: {}'.format(fname), exc_info=signal)
+        for _, job_index, arg in group:
+            if isinstance(signal, Exception):
+                save(job_index, [[], fname])
+            else:
+                yield (jobs[job_index][1], job_index, signal) + tuple(arg[1:])
@@ -48,7 +48,7 @@ def main(results_dir=None):
     #
     # Read in harmonix dataset
     #
-    dataset = HarmonixDataset()
+    dataset = HarmonixDataset(use_cache=True)
     reference_data = dataset.beat_time_lists
     reference_data = {os.path.splitext(os.path.basename(fname))[0]: value for fname, value in reference_data.items()}
 
@@ -46,7 +46,7 @@ def main(results_dir=None):
     #
     # Read in harmonix dataset
     #
-    dataset = HarmonixDataset()
+    dataset = HarmonixDataset(use_cache=True)
     reference_data = dataset.downbeat_time_lists(0)
     reference_data = {os.path.splitext(os.path.basename(fname))[0]: value for fname, value in reference_data.items()}
     # NOTE [matt.c.mccallum 09.02.19]: The results provided by Durand estimated the position of the end of the first
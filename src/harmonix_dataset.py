@@ -4,17 +4,86 @@ Created 04-06-19 by Matt C. McCallum
 
 
 # Local imports
-# None.
+from annotation_cache import source_fingerprint
+from annotation_cache import compile_annotations
+from annotation_cache import load_annotations
+from annotation_cache import pack_annotations
+from annotation_io import LoadStats
+from annotation_io import parse_beats
+from annotation_io import parse_segments
+from annotation_io import read_annotation_file
+from annotation_io import read_annotation_files
+from track_metadata import TrackMetadata
+from annotation_index import AnnotationIndex
+from dataset_statistics import DatasetStatistics
+from track_batches import iter_track_batches
+from track_batches import FEATURE_SUFFIXES
+from jams_loader import read_jams_dir
+from jams_loader import compare_annotations
+from jams_loader import DEFAULT_TOLERANCE
 
 # Third party imports
-import pandas as pd
 import numpy as np
 
 # Python standard library imports
 import os
+import collections
+import collections.abc
+import threading
+import types
+import logging
 
 
 DEFAULT_DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../dataset')
+DEFAULT_CACHE_SIZE = 128
+
+
+class _LazyTrackData(collections.abc.Mapping):
+    """
+    A read-only mapping from track ID to the annotation data of that track, where each track's
+    annotation file is only parsed on first access. Parsed tracks are kept in a bounded LRU cache
+    so that the memory footprint depends on the working set rather than the size of the dataset.
+    """
+
+    def __init__(self, track_files, loader, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Constructor.
+
+        Args:
+            track_files: dict(str, str) - The annotation filename (with path) for each track ID.
+
+            loader: function - A function that takes an annotation filename and returns the parsed data.
+
+            cache_size: int or None - The maximum number of parsed tracks to hold in memory at once.
+            If None, the cache is unbounded and every track is parsed at most once.
+        """
+        self._track_files = track_files
+        self._loader = loader
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, track_id):
+        with self._lock:
+            if track_id in self._cache:
+                self._cache.move_to_end(track_id)
+                return self._cache[track_id]
+        data = self._loader(self._track_files[track_id])
+        with self._lock:
+            self._cache[track_id] = data
+            if self._cache_size is not None:
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return data
+
+    def __contains__(self, track_id):
+        return track_id in self._track_files
+
+    def __iter__(self):
+        return iter(self._track_files)
+
+    def __len__(self):
+        return len(self._track_files)
 
 
 class HarmonixDataset(object):
@@ -22,7 +91,8 @@ class HarmonixDataset(object):
     An object for interfacing with the Harmonix dataset data.
     """
 
-    def __init__(self, dataset_dir=DEFAULT_DATASET_DIR):
+    def __init__(self, dataset_dir=DEFAULT_DATASET_DIR, lazy=False, cache_size=DEFAULT_CACHE_SIZE, use_cache=False,
+                 cache_dir=None, num_workers=1, executor='thread', parser='pandas'):
         """
         Constructor.
 
@@ -30,6 +100,29 @@ class HarmonixDataset(object):
             dataset_dir: str - An absolute path to the directory in which the dataset
             dat files exist. They are expected to be organized into subfolders therein,
             "beats_and_downbeats" and "segments".
+
+            lazy: bool - If True, only the track IDs are listed on construction and the annotations
+            for each track are parsed on first access. Otherwise the entire dataset is loaded into
+            memory on construction.
+
+            cache_size: int or None - The maximum number of parsed tracks to keep in memory when
+            `lazy` is True. If None, parsed tracks are never evicted. Ignored when `lazy` is False.
+
+            use_cache: bool - If True, the annotations are loaded by memory-mapping a compiled binary
+            cache of the text files, see `annotation_cache`. The cache is compiled on first use, and
+            recompiled automatically whenever any of the text files change. If the cache cannot be
+            written, e.g., on a read-only dataset mount, the annotations are compiled in memory instead.
+
+            cache_dir: str or None - The directory in which to store the compiled cache. Defaults to
+            ".annotation_cache" within `dataset_dir`.
+
+            num_workers: int - The number of threads or processes used to read the text files whenever
+            every file is read at once, i.e., when not loading lazily, or when compiling the cache.
+
+            executor: str - Either "thread" or "process", the type of pool used when `num_workers` > 1.
+
+            parser: str - Either "pandas", to parse the text files with `pd.read_csv`, or "numpy", for a
+            faster parser that splits the text directly into arrays.
         """
         # Define dataset info
         self._DATA_DIR = os.path.abspath(dataset_dir)
@@ -42,12 +135,166 @@ class HarmonixDataset(object):
         self._SEG_BOUNDARY_COLUMN = 'SegmentStart'
         self._SEG_LABEL_COLUMN = 'SegmentLabel'
         self._SEGMENTS_COLUMNS = [self._SEG_BOUNDARY_COLUMN, self._SEG_LABEL_COLUMN]
+        self._JAMS_DIR = os.path.join(self._DATA_DIR, 'jams')
+        self._METADATA_FILE = os.path.join(self._DATA_DIR, 'metadata.csv')
+        self._ALIGNMENT_SCORES_FILE = os.path.join(self._DATA_DIR, 'youtube_alignment_scores.csv')
 
-        # Load entire dataset into memory
+        self._lazy = lazy
+        self._cache_size = cache_size
+        self._use_cache = use_cache
+        self._cache_dir = cache_dir or os.path.join(self._DATA_DIR, '.annotation_cache')
+        self._num_workers = num_workers
+        self._executor = executor
+        self._parser = parser
+        self._views = {}
+        self._statistics = DatasetStatistics()
+        self.reload()
+
+    def reload(self):
+        """
+        (Re)loads the annotations from the dataset directory, picking up any added, removed or
+        modified annotation files. All cached derived views, e.g., `beat_time_lists`, are invalidated.
+        """
+        self._views = {}
+        self._load_stats = LoadStats()
         self._beat_files = [os.path.join(self._BEAT_DIR, fname) for fname in os.listdir(self._BEAT_DIR)]
         self._seg_files = [os.path.join(self._SEGMENT_DIR, fname) for fname in os.listdir(self._SEGMENT_DIR)]
-        self._beat_data = {os.path.splitext(os.path.basename(fname))[0]:pd.read_csv(fname, names=self._BEATS_COLUMNS, delimiter='\t') for fname in self._beat_files}
-        self._seg_data = {os.path.splitext(os.path.basename(fname))[0]:pd.read_csv(fname, names=self._SEGMENTS_COLUMNS, delimiter=' ') for fname in self._seg_files}
+        beat_files = {self._track_id(fname): fname for fname in self._beat_files}
+        seg_files = {self._track_id(fname): fname for fname in self._seg_files}
+        self._compiled = None
+        if self._use_cache:
+            # Build dataframes on access from the memory-mapped compiled arrays
+            compiled = self._compiled = self._load_compiled(self._cache_dir, beat_files, seg_files)
+            track_keys = {track_id: track_id for track_id in beat_files}
+            compiled_cache_size = self._cache_size if self._lazy else None
+            self._beat_data = _LazyTrackData(track_keys, lambda track_id: compiled.beat_frame(track_id, self._BEATS_COLUMNS),
+                                             compiled_cache_size)
+            self._seg_data = _LazyTrackData(track_keys, lambda track_id: compiled.segment_frame(track_id, self._SEGMENTS_COLUMNS),
+                                            compiled_cache_size)
+        elif self._lazy:
+            # Only parse each track on first access
+            self._beat_data = _LazyTrackData(beat_files, self._read_beat_file, self._cache_size)
+            self._seg_data = _LazyTrackData(seg_files, self._read_segment_file, self._cache_size)
+        else:
+            # Load entire dataset into memory
+            self._beat_data, self._seg_data = self._read_all(beat_files, seg_files)
+
+    def _view(self, key, compute):
+        """
+        Get a derived view of the dataset, computing it only on first access. Views are cached on
+        the dataset object until the next call to `reload`.
+
+        Args:
+            key: hashable - An identifier for the view.
+
+            compute: function - A function taking no arguments that computes the view.
+
+        Return:
+            * - The cached view.
+        """
+        views = self._views
+        if key not in views:
+            views[key] = compute()
+        return views[key]
+
+    def _load_compiled(self, cache_dir, beat_files, seg_files):
+        """
+        Memory-maps the compiled annotation cache, compiling it first from the text files if it
+        does not exist or is out of date.
+
+        Args:
+            cache_dir: str - The directory in which compiled caches are stored.
+
+            beat_files: dict(str, str) - The beats and downbeats filename for each track ID.
+
+            seg_files: dict(str, str) - The segments filename for each track ID.
+
+        Return:
+            CompiledAnnotations - The compiled annotations for every track.
+        """
+        fingerprint = source_fingerprint(list(beat_files.values()) + list(seg_files.values()))
+        compiled = load_annotations(cache_dir, fingerprint)
+        if compiled is None:
+            beat_data, seg_data = self._read_all(beat_files, seg_files)
+            arrays = self._frames_to_arrays(beat_data, seg_data)
+            try:
+                compile_annotations(cache_dir, fingerprint, *arrays)
+            except OSError:
+                logging.warning('Could not write the annotation cache to "{}", compiling in memory'.format(cache_dir),
+                                exc_info=True)
+                return pack_annotations(*arrays)
+            compiled = load_annotations(cache_dir, fingerprint)
+        return compiled
+
+    def _frames_to_arrays(self, beat_data, seg_data):
+        """
+        Converts per-track beat and segment dataframes into the arrays expected by `annotation_cache`.
+        """
+        beat_arrays = {track_id: df.values for track_id, df in beat_data.items()}
+        seg_arrays = {track_id: (df[self._SEG_BOUNDARY_COLUMN].values, df[self._SEG_LABEL_COLUMN].values)
+                      for track_id, df in seg_data.items()}
+        return beat_arrays, seg_arrays
+
+    @staticmethod
+    def _track_id(fname):
+        """
+        Get the track ID for an annotation file, i.e., its basename without extension.
+        """
+        return os.path.splitext(os.path.basename(fname))[0]
+
+    def _read_beat_file(self, fname):
+        """
+        Parses a single beats and downbeats annotation file into a dataframe.
+        """
+        return read_annotation_file(fname, parse_beats, self._BEATS_COLUMNS, self._parser, self._load_stats)
+
+    def _read_segment_file(self, fname):
+        """
+        Parses a single segment annotation file into a dataframe.
+        """
+        return read_annotation_file(fname, parse_segments, self._SEGMENTS_COLUMNS, self._parser, self._load_stats)
+
+    def _read_all(self, beat_files, seg_files):
+        """
+        Parses every beats and downbeats, and segment annotation file, using `num_workers` threads or processes.
+
+        Args:
+            beat_files: dict(str, str) - The beats and downbeats filename for each track ID.
+
+            seg_files: dict(str, str) - The segments filename for each track ID.
+
+        Return:
+            tuple(dict(str, pd.DataFrame), dict(str, pd.DataFrame)) - The beat and segment data for each track ID.
+        """
+        read_kwargs = {'parser': self._parser, 'num_workers': self._num_workers, 'executor': self._executor,
+                       'stats': self._load_stats}
+        beat_data = read_annotation_files(list(beat_files.values()), parse_beats, self._BEATS_COLUMNS, **read_kwargs)
+        seg_data = read_annotation_files(list(seg_files.values()), parse_segments, self._SEGMENTS_COLUMNS, **read_kwargs)
+        return ({track_id: beat_data[fname] for track_id, fname in beat_files.items()},
+                {track_id: seg_data[fname] for track_id, fname in seg_files.items()})
+
+    @property
+    def load_stats(self):
+        """
+        Get timing statistics for the annotation text files read since the dataset was last (re)loaded,
+        e.g., files per second, the slowest files, and the split between I/O and parse time. When loading
+        lazily, the wall time is the summed time of each file, see `annotation_io.LoadStats`.
+
+        Return:
+            annotation_io.LoadStats - The load statistics. Empty if everything was loaded from the compiled cache.
+        """
+        return self._load_stats
+
+    @property
+    def track_ids(self):
+        """
+        Get the IDs of all tracks in the dataset, without parsing any annotations.
+
+        Return:
+            list(str) - The track IDs, e.g., "0001_12step", corresponding to the annotation
+            filenames without extension.
+        """
+        return list(self._beat_data.keys())
 
     @property
     def beat_dataframe(self):
@@ -58,7 +305,8 @@ class HarmonixDataset(object):
             dict(str, pd.DataFrame) - The beat and downbeat times for every track in the dataset.
             The dataframes are composed of three columns. The first, beat times in seconds. The second,
             beat counts within each bar, e.g., 1, 2, 3, 4, 1, 2.... The third, bar counts, the bar number
-            that each beat-row corresponds to.
+            that each beat-row corresponds to. When the dataset was constructed with `lazy=True`
+            this is a read-only mapping that parses each track on first access.
         """
         return self._beat_data
 
@@ -71,38 +319,207 @@ class HarmonixDataset(object):
             dict(str, pd.DataFrame) - The beat times in seconds for every track in the dataset. Each dataframe
             has two columns, the first specifying the start location of a segment in seconds, and the second
             column specifying the name / label of that segment. There is an additional 'end' label to specify
-            the end of a track.
+            the end of a track. When the dataset was constructed with `lazy=True` this is a read-only
+            mapping that parses each track on first access.
         """
         return self._seg_data
 
+    @property
+    def time_index(self):
+        """
+        Get an index for looking up which segment, beat or bar contains each of an array of timestamps,
+        e.g., `dataset.time_index.segment_labels_at('0001_12step', frame_times)`. Built once and cached until
+        the next call to `reload`.
+
+        Return:
+            annotation_index.AnnotationIndex - The index over the annotations of every track.
+        """
+        return self._view('time_index', lambda: AnnotationIndex(self.annotations))
+
+    @property
+    def statistics(self):
+        """
+        Get descriptive statistics of the annotations, e.g., label counts, segment and beat length
+        distributions, tempo and beats per bar of each track. These are computed on first access and,
+        after a call to `reload`, only recomputed for tracks that were added or modified.
+
+        Return:
+            dataset_statistics.DatasetStatistics - The statistics of every track.
+        """
+        return self._view('statistics', lambda: self._statistics.update(self.annotations))
+
+    @property
+    def jams_annotations(self):
+        """
+        Get the annotations of every track as read from the JAMS files, in the same ragged representation
+        as `annotations`. The JAMS files are read with `num_workers` threads or processes, once, and cached
+        until the next call to `reload`.
+
+        Return:
+            annotation_cache.CompiledAnnotations - The beats, beat numbers, bar numbers and segments
+            of every track.
+        """
+        return self._view('jams_annotations', lambda: read_jams_dir(self._JAMS_DIR, self.track_ids, self._num_workers,
+                                                                    self._executor))
+
+    def jams_disagreements(self, tolerance=DEFAULT_TOLERANCE):
+        """
+        Compares the annotations in the JAMS files to those in the text files.
+
+        Args:
+            tolerance: float - The maximum difference in seconds for two times to be considered equal.
+
+        Return:
+            list(tuple(str, str)) - The track ID and a description of each disagreement found.
+        """
+        return compare_annotations(self.annotations, self.jams_annotations, tolerance)
+
+    @property
+    def metadata(self):
+        """
+        Get the track metadata joined with the YouTube alignment scores, indexed for filter queries, e.g.,
+
+            dataset.metadata.query(genre='Hip-Hop', time_signature='4|4', bpm=(80, 100), alignment_score=(0.95, None))
+
+        This is loaded once and cached until the next call to `reload`.
+
+        Return:
+            track_metadata.TrackMetadata - The metadata for every track.
+        """
+        return self._view('metadata', lambda: TrackMetadata(self._METADATA_FILE, self._ALIGNMENT_SCORES_FILE))
+
     @property
     def beat_time_lists(self):
         """
-        Returns the annotated positions of beats in seconds for every track.
+        Returns the annotated positions of beats in seconds for every track. This view is computed
+        once and cached until the next call to `reload`.
+
+        Return:
+            dict(str, list(float)) - A read-only dictionary containing read-only arrays of beat times
+            in second for each dictionary key, in turn specifying a track. The arrays are views into
+            `annotations`, not copies.
+        """
+        def compute():
+            annotations = self.annotations
+            return types.MappingProxyType(annotations.beats.to_dict(annotations.track_ids))
+        return self._view('beat_time_lists', compute)
+
+    @property
+    def annotations(self):
+        """
+        Get the annotations of the entire dataset in a ragged representation, i.e., flat arrays of
+        values for all tracks along with per-track offsets. Unless the dataset was constructed with
+        `use_cache=True`, this packs the annotations of every track on first access, parsing them if
+        loaded lazily, and caches the result until the next call to `reload`.
+
+        Return:
+            annotation_cache.CompiledAnnotations - The beats, beat numbers, bar numbers and segments
+            of every track.
+        """
+        if self._compiled is not None:
+            return self._compiled
+        return self._view('annotations', lambda: pack_annotations(*self._frames_to_arrays(self._beat_data, self._seg_data)))
+
+    def downbeat_times(self, offsets):
+        """
+        Returns the annotated positions of downbeats in seconds for every track, for several beat offsets
+        at once. This is computed in a single vectorized pass over the whole dataset, for any offsets that
+        have not been requested since the last call to `reload`.
+
+        Args:
+            offsets: list(int) - The numbers of beats to offset the downbeat position by, for example
+            0 = the downbeat, 1 = the second beat, etc..
 
         Return:
-            dict(str, list(float)) - A dictionary containing lists of beat times in second
-            for each dictionary key, in turn specifying a track.
+            dict(int, annotation_cache.RaggedArray) - For each offset, the downbeat + beat offset times
+            in seconds for every track, in the order of `annotations.track_ids`.
         """
-        return {fname: data[self._BEAT_MARKER_COLUMN].values for fname, data in self._beat_data.items()}
+        missing = [offset for offset in offsets if ('downbeat_times', offset) not in self._views]
+        if missing:
+            for offset, downbeats in self.annotations.downbeat_times(missing).items():
+                self._views[('downbeat_times', offset)] = downbeats
+        return {offset: self._views[('downbeat_times', offset)] for offset in offsets}
 
     def downbeat_time_lists(self, offset):
         """
-        Returns the annotated positions of downbeats in seconds for every track.
+        Returns the annotated positions of downbeats in seconds for every track. This view is computed
+        once per offset and cached until the next call to `reload`.
+
+        NOTE: This keeps the convention used for the published evaluation, which differs from `downbeat_times`.
+              Here, each bar other than the first of a track is located by the last beat of the previous bar,
+              i.e., `downbeat_time_lists(offset)` gives the bar starts of `downbeat_times([offset - 1])`,
+              while the first beat of a track is included, unshifted, only if the track starts on bar 1.
 
         Args:
             offset: int - The number of beats to offset the downbeat position by, for example
             0 = the downbeat, 1 = the second beat, etc..
 
         Return:
-            dict(str, list(float)) - A dictionary containing lists of downbeat + beat offset times 
-            in seconds for each dictionary key, in turn specifying a track.
+            dict(str, list(float)) - A read-only dictionary containing read-only arrays of downbeat + beat
+            offset times in seconds for each dictionary key, in turn specifying a track.
         """
-        downbeats_each_track = {}
-        for fname, df in self._beat_data.items():
-            bar_numbers = np.array(df[self._BAR_NUMBER_COLUMN])
-            bar_start_idxs = np.argwhere((bar_numbers[1:]-bar_numbers[:-1])>0) + offset # <= We ignore the last bar as it is usually incomplete - e.g., the final beat
-            if bar_numbers[0] == 1:
-                bar_start_idxs = np.concatenate((np.array([0]), bar_start_idxs.flatten()))
-            downbeats_each_track[os.path.splitext(fname)[0]] = df[self._BEAT_MARKER_COLUMN].values[bar_start_idxs].flatten()
-        return downbeats_each_track
+        def compute():
+            annotations = self.annotations
+            bar_starts = annotations.bar_start_rows()
+            first_rows = np.isin(bar_starts, annotations.beat_offsets[:-1])
+            rows = np.concatenate((bar_starts[first_rows & (annotations.bar_numbers[bar_starts] == 1)],
+                                   annotations.shift_rows(bar_starts[~first_rows], offset - 1)))
+            downbeats = annotations.beat_times_at(np.sort(rows, kind='stable'))
+            return types.MappingProxyType(downbeats.to_dict(annotations.track_ids))
+        return self._view(('downbeat_time_lists', offset), compute)
+
+    def iter_batches(self, batch_size, track_ids=None, shuffle=False, seed=None, drop_last=False, features_dir=None,
+                     feature_type='mel', downbeat_offset=0, prefetch=2, num_workers=4):
+        """
+        Iterates over batches of tracks, loading the next `prefetch` batches in background threads
+        while the current batch is consumed.
+
+        Args:
+            batch_size: int - The number of tracks in each batch.
+
+            track_ids: list(str) or None - The tracks to iterate over, e.g., as returned by `metadata.query`.
+            If None, all tracks are iterated over.
+
+            shuffle: bool - If True, the tracks are iterated in a random order.
+
+            seed: int or None - The seed for the random order. The same seed always yields the same order.
+
+            drop_last: bool - If True, a final batch smaller than `batch_size` is not yielded.
+
+            features_dir: str or None - A directory of precomputed audio features, as written by
+            `compute_librosa_audio_features.py` or `compute_madmom_audio_features.py`. If None, no features
+            are loaded.
+
+            feature_type: str - Either "mel" for "<track_id>-mel.npy" files, or "seq" for "<track_id>-seq.npy" files.
+
+            downbeat_offset: int - The beat offset of the downbeats, see `downbeat_times`. With the default of 0,
+            the "downbeats" are the first beat of every bar.
+
+            prefetch: int - The number of batches to load ahead of the one being consumed.
+
+            num_workers: int - The number of threads loading the tracks of each batch.
+
+        Return:
+            generator(list(dict)) - Lists of tracks, each a dictionary with the "track_id", "beats", "downbeats",
+            "segment_times" and "segment_labels" of the track, and its "features" if `features_dir` is provided.
+        """
+        annotations = self.annotations
+        downbeats = self.downbeat_times([downbeat_offset])[downbeat_offset]
+
+        def load_track(track_id):
+            idx = annotations.track_index(track_id)
+            segments = slice(annotations.segment_offsets[idx], annotations.segment_offsets[idx + 1])
+            track = {
+                'track_id': track_id,
+                'beats': np.asarray(annotations.beats[idx]),
+                'downbeats': np.asarray(downbeats[idx]),
+                'segment_times': np.asarray(annotations.segment_times[segments]),
+                'segment_labels': annotations.label_vocabulary[annotations.segment_labels[segments]]
+            }
+            if features_dir is not None:
+                track['features'] = np.load(os.path.join(features_dir, track_id + FEATURE_SUFFIXES[feature_type]))
+            return track
+
+        if track_ids is None:
+            track_ids = self.track_ids
+        return iter_track_batches(load_track, track_ids, batch_size, shuffle, seed, drop_last, prefetch, num_workers)
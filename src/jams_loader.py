@@ -0,0 +1,171 @@
+"""
+Created 10-17-26
+
+A bulk reader for the JAMS release of the Harmonix Set annotations.
+
+Rather than constructing `jams.JAMS` objects, which validates every annotation of every file,
+the JSON is decoded directly and only the beat and segment namespaces are extracted, into the
+same packed array structures used by `HarmonixDataset.annotations`.
+"""
+
+
+# Local imports
+from annotation_cache import pack_annotations
+from annotation_io import EXECUTORS
+
+# Third party imports
+import numpy as np
+
+# Python standard library imports
+import os
+import json
+
+
+BEAT_NAMESPACE = 'beat'
+SEGMENT_NAMESPACE = 'segment_open'
+END_LABEL = 'end'
+JAMS_EXT = '.jams'
+# NOTE: Times in the JAMS files are rounded to the millisecond, so they may differ from
+#       the text annotations by up to half a millisecond.
+DEFAULT_TOLERANCE = 1e-3
+
+
+def parse_jams(text):
+    """
+    Extracts the beats and segments from the contents of a JAMS file.
+
+    Bar numbers are not stored in the JAMS files, so they are derived from the beat positions,
+    starting a new bar whenever the position within the bar does not increase. The end of the
+    final segment is appended as an "end" segment, as in the segments text files.
+
+    Args:
+        text: str - The JSON contents of the JAMS file.
+
+    Return:
+        tuple(np.ndarray, tuple(np.ndarray, np.ndarray)) - The beat rows (beat time, beat number,
+        bar number) and the segment start times and labels.
+    """
+    annotations = {ann['namespace']: ann['data'] for ann in json.loads(text)['annotations']}
+
+    beats = annotations.get(BEAT_NAMESPACE, [])
+    beat_times = np.array([obs['time'] for obs in beats], dtype=np.float64)
+    beat_numbers = np.array([obs['value'] for obs in beats], dtype=np.int64)
+    bar_numbers = np.ones(len(beats), dtype=np.int64)
+    bar_numbers[1:] += np.cumsum(beat_numbers[1:] <= beat_numbers[:-1])
+
+    segments = annotations.get(SEGMENT_NAMESPACE, [])
+    seg_times = [obs['time'] for obs in segments]
+    seg_labels = [obs['value'] for obs in segments]
+    if segments:
+        seg_times += [segments[-1]['time'] + segments[-1]['duration']]
+        seg_labels += [END_LABEL]
+
+    return (np.stack((beat_times, beat_numbers, bar_numbers), axis=1),
+            (np.array(seg_times, dtype=np.float64), np.array(seg_labels, dtype=object)))
+
+
+def read_jams_file(fname):
+    """
+    Reads the beats and segments from a single JAMS file.
+
+    Args:
+        fname: str - The filename (with path) of the JAMS file.
+
+    Return:
+        tuple(np.ndarray, tuple(np.ndarray, np.ndarray)) - See `parse_jams`.
+    """
+    with open(fname, 'r') as f:
+        return parse_jams(f.read())
+
+
+def read_jams_dir(jams_dir, track_ids=None, num_workers=1, executor='thread'):
+    """
+    Reads the beats and segments from every JAMS file in a directory, optionally in parallel.
+
+    Args:
+        jams_dir: str - The directory containing one JAMS file per track.
+
+        track_ids: list(str) or None - The tracks to read. If None, every JAMS file in `jams_dir` is read.
+
+        num_workers: int - The number of threads or processes to read files with.
+
+        executor: str - Either "thread" or "process", the type of pool used when `num_workers` > 1.
+
+    Return:
+        annotation_cache.CompiledAnnotations - The beats, beat numbers, bar numbers and segments of every track.
+    """
+    if track_ids is None:
+        track_ids = [os.path.splitext(fname)[0] for fname in os.listdir(jams_dir) if fname.endswith(JAMS_EXT)]
+    fnames = [os.path.join(jams_dir, track_id + JAMS_EXT) for track_id in track_ids]
+    if num_workers > 1:
+        with EXECUTORS[executor](num_workers) as pool:
+            results = list(pool.map(read_jams_file, fnames, chunksize=max(1, len(fnames) // (4*num_workers))))
+    else:
+        results = [read_jams_file(fname) for fname in fnames]
+    beat_data = {track_id: result[0] for track_id, result in zip(track_ids, results)}
+    seg_data = {track_id: result[1] for track_id, result in zip(track_ids, results)}
+    return pack_annotations(beat_data, seg_data)
+
+
+def compare_annotations(reference, other, tolerance=DEFAULT_TOLERANCE):
+    """
+    Finds every disagreement between two sets of annotations, e.g., those read from the text
+    files and those read from the JAMS files.
+
+    Args:
+        reference: annotation_cache.CompiledAnnotations - The annotations to compare against.
+
+        other: annotation_cache.CompiledAnnotations - The annotations to compare.
+
+        tolerance: float - The maximum difference in seconds for two times to be considered equal.
+
+    Return:
+        list(tuple(str, str)) - The track ID and a description of each disagreement found.
+    """
+    disagreements = []
+    reference_ids = set(str(track_id) for track_id in reference.track_ids)
+    other_ids = set(str(track_id) for track_id in other.track_ids)
+    for track_id in sorted(reference_ids - other_ids):
+        disagreements += [(track_id, 'missing from compared annotations')]
+    for track_id in sorted(other_ids - reference_ids):
+        disagreements += [(track_id, 'missing from reference annotations')]
+
+    for track_id in sorted(reference_ids & other_ids):
+        ref_idx, other_idx = reference.track_index(track_id), other.track_index(track_id)
+        ref_beats, other_beats = _track_slice(reference, 'beat', ref_idx), _track_slice(other, 'beat', other_idx)
+        if ref_beats.stop - ref_beats.start != other_beats.stop - other_beats.start:
+            disagreements += [(track_id, 'beat count differs: {} != {}'.format(
+                ref_beats.stop - ref_beats.start, other_beats.stop - other_beats.start))]
+        else:
+            time_diff = np.abs(reference.beat_times[ref_beats] - other.beat_times[other_beats])
+            if np.any(time_diff > tolerance):
+                disagreements += [(track_id, '{} beat times differ, by up to {:.6f}s'.format(
+                    np.sum(time_diff > tolerance), np.max(time_diff)))]
+            for name in ['beat_numbers', 'bar_numbers']:
+                num_diff = np.sum(getattr(reference, name)[ref_beats] != getattr(other, name)[other_beats])
+                if num_diff:
+                    disagreements += [(track_id, '{} {} differ'.format(num_diff, name.replace('_', ' ')))]
+
+        ref_segs, other_segs = _track_slice(reference, 'segment', ref_idx), _track_slice(other, 'segment', other_idx)
+        if ref_segs.stop - ref_segs.start != other_segs.stop - other_segs.start:
+            disagreements += [(track_id, 'segment count differs: {} != {}'.format(
+                ref_segs.stop - ref_segs.start, other_segs.stop - other_segs.start))]
+        else:
+            time_diff = np.abs(reference.segment_times[ref_segs] - other.segment_times[other_segs])
+            if np.any(time_diff > tolerance):
+                disagreements += [(track_id, '{} segment times differ, by up to {:.6f}s'.format(
+                    np.sum(time_diff > tolerance), np.max(time_diff)))]
+            ref_labels = reference.label_vocabulary[reference.segment_labels[ref_segs]]
+            other_labels = other.label_vocabulary[other.segment_labels[other_segs]]
+            for pos in np.flatnonzero(ref_labels != other_labels):
+                disagreements += [(track_id, 'segment {} label differs: "{}" != "{}"'.format(
+                    pos, ref_labels[pos], other_labels[pos]))]
+    return disagreements
+
+
+def _track_slice(annotations, kind, idx):
+    """
+    Get the slice of the beat or segment arrays belonging to a single track.
+    """
+    offsets = getattr(annotations, kind + '_offsets')
+    return slice(offsets[idx], offsets[idx + 1])
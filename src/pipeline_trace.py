@@ -0,0 +1,207 @@
+"""
+Created 10-17-26
+
+Profiling of the estimator pipeline, recording where the time goes in the analysis of each track.
+
+The analysis of a track is divided into stages, e.g., "decode" or "activation", each timed where it happens
+with `stage`. The times of the stages of a task are collected with `traced_task`, and the records of every
+task in a run are written as JSON lines and summarized by a `PipelineTrace`.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+# None.
+
+# Python standard library imports
+import json
+import time
+import threading
+import logging
+from contextlib import contextmanager
+
+
+# The stages of the analysis of a track, in the order they happen.
+STAGES = [
+    'mp3_header',       # Reading mp3 headers, e.g., for the number of channels or the duration.
+    'decode',           # Decoding mp3 data with ffmpeg.
+    'decode_wait',      # Waiting for audio decoded ahead of the analysis, see `decode_pipeline`.
+    'audio_cache',      # Reading, writing and evicting decoded audio in the cache, see `audio_cache`.
+    'resample',         # Resampling decoded audio to the rates an estimator needs.
+    'wav_write',        # Writing audio to a temporary wav file, for estimators that read a file.
+    'activation',       # Computing, or reading stored, neural network activations.
+    'post_processing',  # The rest of the estimator, e.g., the post-processing of the activations.
+    'result_write'      # Saving the estimates.
+]
+
+# The stage times of the task being traced in each thread, if any, see `traced_task`.
+_LOCAL = threading.local()
+
+
+@contextmanager
+def traced_task():
+    """
+    Collects the times of the stages run in this thread for the duration of the context.
+
+    Return:
+        dict(str, float) - The time in seconds spent in each stage that was run, filled in as the stages
+        complete.
+    """
+    previous = (getattr(_LOCAL, 'stages', None), getattr(_LOCAL, 'nested', None))
+    _LOCAL.stages, _LOCAL.nested = {}, []
+    try:
+        yield _LOCAL.stages
+    finally:
+        _LOCAL.stages, _LOCAL.nested = previous
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the task being traced in this thread, if any, see `traced_task`. The time spent in stages
+    nested within this one is only counted towards those, such that the stages of a task add up to at most
+    its duration.
+
+    Args:
+        name: str - The name of the stage, see `STAGES`.
+    """
+    stages = getattr(_LOCAL, 'stages', None)
+    if stages is None:
+        yield
+        return
+    nested = _LOCAL.nested
+    nested += [0.0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stages[name] = stages.get(name, 0.0) + elapsed - nested.pop()
+        if nested:
+            nested[-1] += elapsed
+
+
+class PipelineTrace(object):
+    """
+    The records of the tasks of a run, written as JSON lines as they are added, and summarized at the end of
+    the run.
+    """
+
+    def __init__(self, trace_fname=None):
+        """
+        Constructor.
+
+        Args:
+            trace_fname: str or None - The filename (with path) of the file to write the JSON lines to. If None,
+            the records are only summarized.
+        """
+        self._trace_file = open(trace_fname, 'w') if trace_fname is not None else None
+        self._start = time.perf_counter()
+        self._stages = {}
+        self._estimators = {}
+        self._peak_rss = {}
+
+    def add_task(self, estimator_name, fname, duration, seconds, stages, pid, peak_rss):
+        """
+        Adds the record of an analysis task.
+
+        Args:
+            estimator_name: str - The name of the estimator.
+
+            fname: str - The filename (with path) of the mp3 file analyzed.
+
+            duration: float - The duration of the audio in seconds.
+
+            seconds: float - The time the task took in seconds.
+
+            stages: dict(str, float) - The time in seconds spent in each stage, see `traced_task`.
+
+            pid: int - The ID of the process that ran the task.
+
+            peak_rss: int - The peak resident memory in bytes of that process so far.
+        """
+        self._write(event='task', estimator=estimator_name, file=fname, duration=duration, seconds=seconds,
+                    stages=stages, pid=pid, peak_rss=peak_rss)
+        self.add_stages(stages, duration)
+        totals = self._estimators.setdefault(estimator_name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += seconds
+        self._peak_rss[pid] = max(self._peak_rss.get(pid, 0), peak_rss)
+
+    def add_stages(self, stages, duration=0.0):
+        """
+        Adds stage times that are not part of a task's record, e.g., those of the process running the tasks.
+
+        Args:
+            stages: dict(str, float) - The time in seconds spent in each stage.
+
+            duration: float - The duration in seconds of the audio processed in the stages.
+        """
+        for name, seconds in stages.items():
+            totals = self._stages.setdefault(name, [0.0, 0.0])
+            totals[0] += duration
+            totals[1] += seconds
+
+    def summary(self):
+        """
+        Get the summary of the run so far.
+
+        Return:
+            dict(str, *) - The wall time of the run in seconds, and the peak resident memory of each process
+            in bytes. The number of tasks, the duration of their audio, the time spent, and the throughput
+            as the duration of audio analyzed per second spent, of each estimator, and likewise of each stage.
+        """
+        throughput = lambda duration, seconds: duration/seconds if seconds > 0 else None
+        return {
+            'seconds': time.perf_counter() - self._start,
+            'peak_rss': {str(pid): rss for pid, rss in sorted(self._peak_rss.items())},
+            'estimators': {name: {'tasks': num_tasks, 'duration': duration, 'seconds': seconds,
+                                  'throughput': throughput(duration, seconds)}
+                           for name, (num_tasks, duration, seconds) in sorted(self._estimators.items())},
+            'stages': {name: {'duration': self._stages[name][0], 'seconds': self._stages[name][1],
+                              'throughput': throughput(*self._stages[name])}
+                       for name in sorted(self._stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES))}
+        }
+
+    def close(self):
+        """
+        Logs the summary of the run, and writes it as the last line of the trace file.
+        """
+        summary = self.summary()
+        self._write(event='summary', **summary)
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+        logging.info('Analyzed for {:.1f}s, peak worker memory {:.0f}MB'.format(
+            summary['seconds'], max(summary['peak_rss'].values(), default=0)/1024**2))
+        for name, totals in summary['estimators'].items():
+            logging.info('  Estimator "{}": {} tasks, {:.1f}s, {}'.format(
+                name, totals['tasks'], totals['seconds'], _format_throughput(totals['throughput'])))
+        for name, totals in summary['stages'].items():
+            logging.info('  Stage "{}": {:.1f}s, {}'.format(name, totals['seconds'],
+                                                          _format_throughput(totals['throughput'])))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, **record):
+        """
+        Writes a record as a line of the trace file, if any.
+        """
+        if self._trace_file is not None:
+            self._trace_file.write(json.dumps(record) + '\n')
+            self._trace_file.flush()
+
+
+def _format_throughput(throughput):
+    """
+    Get a throughput as a multiple of real time, for logging.
+    """
+    return '{:.1f}x real time'.format(throughput) if throughput is not None else 'no audio'
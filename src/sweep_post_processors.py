@@ -0,0 +1,154 @@
+"""
+Created 10-17-26
+
+Reruns a madmom post-processor, e.g., `DBNBeatTrackingProcessor`, over the neural network activations saved by
+`estimate_beats.py` or `estimate_downbeats.py` with `--activation-dir`, for every combination of a grid of
+parameters, without rerunning the networks:
+
+    python sweep_post_processors.py --activation-dir activations --processor DBNBeatTrackingProcessor \
+        --grid '{"min_bpm": [55, 60], "max_bpm": [180, 215], "transition_lambda": [50, 100]}'
+
+The estimates for each combination of parameters are saved in a directory of their own, in the same format
+as the estimators' results, e.g., to be evaluated by `evaluate_beats.py`.
+"""
+
+
+# Local imports
+from activation_store import ActivationStore
+from activation_store import madmom_version
+from estimator_utils import cached_processor
+from estimate_downbeats import downbeat_times
+from worker_pool import WorkerPool
+
+# Third party imports
+import madmom
+
+# Python standard library imports
+import argparse
+import itertools
+import json
+import os
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+# The post-processors that can be swept, by name, each with the madmom module providing it, the processor whose
+# activations it takes, whether its output is beats numbered within the bar, that downbeats are taken from, and
+# the parameters it is run with by the estimators, unless swept.
+POST_PROCESSORS = {
+    'DBNBeatTrackingProcessor': ('beats', 'RNNBeatProcessor', False, {'fps': 100}),
+    'CRFBeatDetectionProcessor': ('beats', 'RNNBeatProcessor', False, {'fps': 100}),
+    'BeatDetectionProcessor': ('beats', 'RNNBeatProcessor', False, {'fps': 100}),
+    'BeatTrackingProcessor': ('beats', 'RNNBeatProcessor', False, {'fps': 100}),
+    'OnsetPeakPickingProcessor': ('onsets', 'RNNBeatProcessor', False, {'fps': 100}),
+    'DBNDownBeatTrackingProcessor': ('downbeats', 'RNNDownBeatProcessor', True, {'beats_per_bar': [3, 4], 'fps': 100}),
+    'DBNBarTrackingProcessor': ('downbeats', 'RNNBarProcessor', True, {'beats_per_bar': [3, 4]})
+}
+
+
+def sweep_track(store, processor, version, params, track_id, output_dir):
+    """
+    Runs a post-processor over the stored activations of a track, saving its estimates.
+
+    Args:
+        store: activation_store.ActivationStore - The store holding the activations.
+
+        processor: str - The name of the post-processor, see `POST_PROCESSORS`.
+
+        version: str - The version of the stored activations.
+
+        params: dict(str, *) - The keyword arguments of the post-processor, in addition to its defaults.
+
+        track_id: str - The ID of the track.
+
+        output_dir: str - The directory to save the estimates to.
+
+    Return:
+        str - The ID of the track.
+    """
+    module, activations_processor, numbered, defaults = POST_PROCESSORS[processor]
+    proc = cached_processor(getattr(getattr(madmom.features, module), processor), **dict(defaults, **params))
+    estimates = proc(store.get(track_id, activations_processor, version))
+    if numbered:
+        estimates = downbeat_times(estimates)
+    with open(os.path.join(output_dir, track_id + '.txt'), 'w') as f:
+        f.write('\n'.join([str(time_marker) for time_marker in estimates]))
+    return track_id
+
+
+def param_grid(grid):
+    """
+    Get every combination of the values of a grid of parameters.
+
+    Args:
+        grid: dict(str, list(*)) - The values of each parameter.
+
+    Return:
+        list(dict(str, *)) - The value of each parameter, for each combination.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def main(activation_dir, results_dir, processor, grid, version=None, num_threads=12):
+    """
+    Reruns a post-processor over stored activations for every combination of a grid of parameters.
+
+    Args:
+        activation_dir: str - The directory of the activation store, see `activation_store.ActivationStore`.
+
+        results_dir: str - The directory to save the estimates to, in a subdirectory named after the processor,
+        and within it a subdirectory named after each combination of parameters.
+
+        processor: str - The name of the post-processor, see `POST_PROCESSORS`.
+
+        grid: dict(str, list(*)) - The values of each parameter of the post-processor to sweep. Parameters that
+        are not swept take the values used by the estimators, see `POST_PROCESSORS`.
+
+        version: str or None - The version of the activations to use. If None, the activations of the installed
+        madmom release are used, which for `RNNBarProcessor` must only have been stored for one set of beats.
+
+        num_threads: int - The number of worker processes.
+    """
+    store = ActivationStore(activation_dir)
+    activations_processor = POST_PROCESSORS[processor][1]
+    if version is None:
+        versions = [v for v in store.versions(activations_processor)
+                    if v == madmom_version() or v.startswith(madmom_version() + '-')]
+        if len(versions) != 1:
+            raise Exception('Found {} versions of stored {} activations, specify one of: {}'.format(
+                len(versions), activations_processor, ', '.join(store.versions(activations_processor))))
+        version = versions[0]
+    track_ids = store.track_ids(activations_processor, version)
+    logging.info('Sweeping {} over the {} activations of {} tracks'.format(processor, version, len(track_ids)))
+
+    tasks = []
+    for params in param_grid(grid):
+        output_dir = os.path.join(results_dir, processor,
+                                  ','.join('{}={}'.format(name, json.dumps(value).replace(' ', ''))
+                                           for name, value in sorted(params.items())))
+        os.makedirs(output_dir, exist_ok=True)
+        tasks += [(store, processor, version, params, track_id, output_dir) for track_id in track_ids]
+    if num_threads > 1:
+        with WorkerPool(num_threads) as the_pool:
+            for _ in the_pool.imap_unordered(sweep_track, tasks):
+                pass
+    else:
+        for task in tasks:
+            sweep_track(*task)
+
+
+if __name__=='__main__':
+    THIS_PATH = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Reruns a madmom post-processor over stored activations for a grid of parameters')
+    parser.add_argument('--activation-dir', required=True, type=str)
+    parser.add_argument('--results-dir', default=os.path.join(THIS_PATH, '../results/sweeps'), type=str)
+    parser.add_argument('--processor', required=True, choices=list(POST_PROCESSORS))
+    parser.add_argument('--grid', default={}, type=json.loads,
+                        help='A JSON object of the values of each parameter, e.g., \'{"fps": [100], "beats_per_bar": [[3, 4], [4]]}\'')
+    parser.add_argument('--version', default=None, type=str)
+    parser.add_argument('--num-threads', default=12, type=int)
+    kwargs = vars(parser.parse_args())
+    main(**kwargs)
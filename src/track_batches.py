@@ -0,0 +1,105 @@
+"""
+Created 10-17-26
+
+Iteration over batches of tracks, loading upcoming batches in background threads while the
+current batch is being consumed.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+
+# Python standard library imports
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+FEATURE_SUFFIXES = {
+    'mel': '-mel.npy',
+    'seq': '-seq.npy'
+}
+_DONE = object()
+
+
+def iter_track_batches(load_track, track_ids, batch_size, shuffle=False, seed=None, drop_last=False, prefetch=2,
+                       num_workers=4):
+    """
+    Yields batches of loaded tracks, with the next `prefetch` batches loaded in the background.
+
+    Args:
+        load_track: function - A function that takes a track ID and returns the data for that track.
+
+        track_ids: list(str) - The IDs of the tracks to iterate over.
+
+        batch_size: int - The number of tracks in each batch.
+
+        shuffle: bool - If True, the tracks are iterated in a random order.
+
+        seed: int or None - The seed for the random order. The same seed always yields the same order.
+
+        drop_last: bool - If True, a final batch smaller than `batch_size` is not yielded.
+
+        prefetch: int - The number of batches to load ahead of the one being consumed.
+
+        num_workers: int - The number of threads loading the tracks of each batch.
+
+    Return:
+        generator(list(*)) - Lists of track data, as returned by `load_track`, in batch order.
+    """
+    track_ids = list(track_ids)
+    if shuffle:
+        track_ids = [track_ids[idx] for idx in np.random.RandomState(seed).permutation(len(track_ids))]
+    batches = [track_ids[start:start + batch_size] for start in range(0, len(track_ids), batch_size)]
+    if drop_last and batches and len(batches[-1]) < batch_size:
+        batches = batches[:-1]
+
+    batch_queue = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def produce():
+        try:
+            with ThreadPoolExecutor(num_workers) as pool:
+                for batch in batches:
+                    if stop.is_set():
+                        return
+                    _put(batch_queue, list(pool.map(load_track, batch)), stop)
+        except Exception as exc:
+            _put(batch_queue, exc, stop)
+        finally:
+            _put(batch_queue, _DONE, stop)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = batch_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Release the producer if the consumer stopped early
+        stop.set()
+        while producer.is_alive():
+            try:
+                batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
+
+
+def _put(batch_queue, item, stop):
+    """
+    Puts an item on the queue, blocking until there is space unless iteration has been stopped.
+    """
+    while not stop.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
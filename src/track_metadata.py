@@ -0,0 +1,168 @@
+"""
+Created 10-17-26
+
+Indexed access to the Harmonix Set track metadata, for selecting subsets of tracks
+to estimate or evaluate.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Python standard library imports
+import os
+
+
+FILE_COLUMN = 'File'
+GENRE_COLUMN = 'Genre'
+TIME_SIGNATURE_COLUMN = 'Time Signature'
+BPM_COLUMN = 'BPM'
+DURATION_COLUMN = 'Duration'
+ALIGNMENT_SCORE_COLUMN = 'Alignment Score'
+CATEGORICAL_COLUMNS = [GENRE_COLUMN, TIME_SIGNATURE_COLUMN]
+NUMERIC_COLUMNS = [BPM_COLUMN, DURATION_COLUMN, ALIGNMENT_SCORE_COLUMN]
+
+
+class TrackMetadata(object):
+    """
+    The metadata of every track in the dataset, joined with the YouTube alignment scores,
+    along with indexes for answering filter queries without scanning every track.
+
+    Categorical columns (genre, time signature) are indexed by a mapping from each value to
+    the rows with that value. Numeric columns (BPM, duration, alignment score) are indexed
+    by their sorted values, so that range queries are resolved with a binary search.
+    """
+
+    def __init__(self, metadata_fname, alignment_scores_fname=None):
+        """
+        Constructor.
+
+        Args:
+            metadata_fname: str - The filename (with path) of the metadata csv file.
+
+            alignment_scores_fname: str or None - The filename (with path) of the YouTube alignment
+            scores csv file. If None, or the file does not exist, all alignment scores are NaN.
+        """
+        data = pd.read_csv(metadata_fname)
+        if alignment_scores_fname is not None and os.path.exists(alignment_scores_fname):
+            scores = pd.read_csv(alignment_scores_fname).rename(columns={'score': ALIGNMENT_SCORE_COLUMN})
+            data = data.merge(scores, on=FILE_COLUMN, how='left')
+        else:
+            data[ALIGNMENT_SCORE_COLUMN] = np.nan
+        self._data = data.set_index(FILE_COLUMN, drop=False)
+        self._track_ids = self._data[FILE_COLUMN].values.astype(str)
+
+        # Build indexes
+        self._categorical_index = {}
+        for column in CATEGORICAL_COLUMNS:
+            groups = self._data.reset_index(drop=True).groupby(column, sort=False).indices
+            self._categorical_index[column] = {value: np.sort(rows) for value, rows in groups.items()}
+        self._numeric_index = {}
+        for column in NUMERIC_COLUMNS:
+            values = self._data[column].values.astype(np.float64)
+            rows = np.flatnonzero(~np.isnan(values))
+            order = rows[np.argsort(values[rows], kind='stable')]
+            self._numeric_index[column] = (values[order], order)
+
+    @property
+    def dataframe(self):
+        """
+        Get the joined metadata.
+
+        Return:
+            pd.DataFrame - The metadata for every track, indexed by track ID, with an additional
+            "Alignment Score" column.
+        """
+        return self._data
+
+    def __getitem__(self, track_id):
+        """
+        Get the metadata for a single track.
+
+        Args:
+            track_id: str - The ID of the track, e.g., "0001_12step".
+
+        Return:
+            pd.Series - The metadata for the track.
+        """
+        return self._data.loc[track_id]
+
+    def values(self, column, track_ids):
+        """
+        Get the values of a column for a list of tracks.
+
+        Args:
+            column: str - The metadata column, e.g., "Duration".
+
+            track_ids: list(str) - The IDs of the tracks.
+
+        Return:
+            np.ndarray - The value for each track, in the order of `track_ids`.
+        """
+        return self._data[column].reindex(track_ids).values
+
+    def query(self, genre=None, time_signature=None, bpm=None, duration=None, alignment_score=None):
+        """
+        Finds the tracks matching all of the given criteria. Criteria that are None are ignored.
+
+        For example, 4|4 Hip-Hop tracks with a BPM of 80 to 100 and an alignment score above 0.95:
+
+            metadata.query(genre='Hip-Hop', time_signature='4|4', bpm=(80, 100), alignment_score=(0.95, None))
+
+        Args:
+            genre: str or list(str) or None - The genre, or any of several genres.
+
+            time_signature: str or list(str) or None - The time signature, e.g., "4|4", or any of several.
+
+            bpm: tuple(float or None, float or None) or None - The inclusive (min, max) BPM range. Either
+            bound may be None for an open range.
+
+            duration: tuple(float or None, float or None) or None - The inclusive (min, max) duration range
+            in seconds.
+
+            alignment_score: tuple(float or None, float or None) or None - The inclusive (min, max) YouTube
+            alignment score range. Tracks without an alignment score never match.
+
+        Return:
+            list(str) - The IDs of the matching tracks, in the order of the metadata file.
+        """
+        matches = None
+        criteria = [
+            (self._categorical_rows, GENRE_COLUMN, genre),
+            (self._categorical_rows, TIME_SIGNATURE_COLUMN, time_signature),
+            (self._range_rows, BPM_COLUMN, bpm),
+            (self._range_rows, DURATION_COLUMN, duration),
+            (self._range_rows, ALIGNMENT_SCORE_COLUMN, alignment_score)
+        ]
+        for lookup, column, criterion in criteria:
+            if criterion is None:
+                continue
+            rows = lookup(column, criterion)
+            matches = rows if matches is None else np.intersect1d(matches, rows, assume_unique=True)
+        if matches is None:
+            return list(self._track_ids)
+        return list(self._track_ids[matches])
+
+    def _categorical_rows(self, column, values):
+        """
+        Get the sorted rows with any of the given values for a categorical column.
+        """
+        index = self._categorical_index[column]
+        if isinstance(values, str):
+            values = [values]
+        rows = [index[value] for value in values if value in index]
+        return np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+
+    def _range_rows(self, column, value_range):
+        """
+        Get the sorted rows with a value in the inclusive range for a numeric column.
+        """
+        sorted_values, order = self._numeric_index[column]
+        low, high = value_range
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+        end = len(sorted_values) if high is None else np.searchsorted(sorted_values, high, side='right')
+        return np.sort(order[start:end])
@@ -0,0 +1,197 @@
+"""
+Created 10-17-26
+
+A pool of persistent worker processes, each of which analyzes many tracks in turn, such that the modules
+and models it loads are reused between tracks, see `estimator_utils.cached_processor`.
+
+Unlike a `multiprocessing.Pool` with `maxtasksperchild`, workers are recycled according to their memory
+usage, i.e., a worker is replaced once its resident memory exceeds a limit after a task, rather than after
+a fixed number of tasks.
+"""
+
+
+# Local imports
+# None.
+
+# Third party imports
+# None.
+
+# Python standard library imports
+import os
+import resource
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+DEFAULT_MAX_RSS = 2*1024**3
+
+
+class WorkerPool(object):
+    """
+    A fixed number of worker processes, that tasks are handed to one at a time as workers become free.
+    """
+
+    def __init__(self, num_workers, max_rss=DEFAULT_MAX_RSS, start_method='forkserver', initializer=None, initargs=()):
+        """
+        Constructor.
+
+        Args:
+            num_workers: int - The number of worker processes.
+
+            max_rss: int or None - The resident memory in bytes above which a worker is replaced once its
+            current task is done. If None, workers are never replaced.
+
+            start_method: str - The multiprocessing start method of the workers. The default fork server
+            starts workers that do not inherit the threads, or the pipes of subprocesses being started
+            meanwhile, of this process.
+
+            initializer: function or None - A function that each worker calls when it starts, e.g., to set
+            up the state that it would otherwise have inherited from this process.
+
+            initargs: tuple(*) - The arguments to `initializer`.
+        """
+        self.max_rss = max_rss
+        self.num_recycled = 0
+        self._initializer = initializer
+        self._initargs = tuple(initargs)
+        self._context = multiprocessing.get_context(start_method)
+        self._idle = [self._start_worker() for _ in range(num_workers)]
+        self._busy = {}
+
+    def imap_unordered(self, func, args):
+        """
+        Applies a function to each of a sequence of argument tuples in the workers, in the order given.
+        The next arguments are only taken from `args` once a worker is free to analyze them, such that a
+        generator of arguments is not run ahead of the workers.
+
+        Args:
+            func: function - A function that is importable from its module, and so can be pickled.
+
+            args: iterable(tuple) - The arguments of each call to `func`.
+
+        Return:
+            generator(*) - The result of each call, in the order the calls complete. If a call raises an
+            exception, an exception with its traceback is raised in turn.
+        """
+        args = iter(args)
+        exhausted = False
+        while True:
+            while self._idle and not exhausted:
+                try:
+                    task_args = next(args)
+                except StopIteration:
+                    exhausted = True
+                    break
+                worker = self._idle.pop()
+                worker[1].send((func, tuple(task_args)))
+                self._busy[worker[1]] = worker
+            if not self._busy:
+                break
+            for conn in wait(list(self._busy)):
+                worker = self._busy.pop(conn)
+                try:
+                    succeeded, result, rss = conn.recv()
+                except EOFError:
+                    worker[0].join()
+                    self._idle += [self._start_worker()]
+                    raise Exception('Worker process exited with code {} during a task'.format(worker[0].exitcode))
+                if self.max_rss is not None and rss > self.max_rss:
+                    self._stop_worker(worker)
+                    worker = self._start_worker()
+                    self.num_recycled += 1
+                self._idle += [worker]
+                if not succeeded:
+                    raise Exception('Task failed in worker process:\n{}'.format(result))
+                yield result
+
+    def close(self):
+        """
+        Stops all workers, abandoning any tasks in progress.
+        """
+        for worker in self._idle:
+            self._stop_worker(worker)
+        for worker in self._busy.values():
+            worker[0].terminate()
+            worker[0].join()
+        self._idle = []
+        self._busy = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start_worker(self):
+        """
+        Starts a worker process.
+
+        Return:
+            tuple(multiprocessing.Process, multiprocessing.connection.Connection) - The process and this
+            process' end of the pipe it takes tasks from and returns results on.
+        """
+        conn, worker_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker, args=(worker_conn, self._initializer, self._initargs),
+                                        daemon=True)
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def _stop_worker(self, worker):
+        """
+        Asks a free worker process to exit and waits for it to do so.
+        """
+        try:
+            worker[1].send(None)
+        except (BrokenPipeError, EOFError):
+            pass
+        worker[1].close()
+        worker[0].join()
+
+
+def current_rss():
+    """
+    Get the resident memory of this process.
+
+    Return:
+        int - The current resident memory in bytes, or the peak where the current is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Get the peak resident memory of this process.
+
+    Return:
+        int - The peak resident memory in bytes since the process started.
+    """
+    # NOTE: `ru_maxrss` is in kilobytes on Linux, and in bytes on macOS.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if os.uname().sysname == 'Darwin' else 1024)
+
+
+def _worker(conn, initializer, initargs):
+    """
+    The main loop of a worker process, running tasks until asked to exit.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, args = task
+        try:
+            result = (True, func(*args))
+        except Exception:
+            result = (False, traceback.format_exc())
+        conn.send(result + (current_rss(),))
+    conn.close()